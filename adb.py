@@ -0,0 +1,401 @@
+import zlib
+
+# the apk v3 ADB container: an optional compression header, then the
+# "ADB." magic, the schema id and a sequence of 8-byte aligned blocks;
+# the first block is the database itself, followed by signatures and,
+# in packages, the file data
+
+ADB_MAGIC = b"ADB."
+
+BLOCK_ADB = 0
+BLOCK_SIG = 1
+BLOCK_DATA = 2
+BLOCK_EXT = 3
+
+BLOCK_ALIGNMENT = 8
+
+COMP_NONE = 0
+COMP_DEFLATE = 1
+
+
+class AdbError(Exception):
+    pass
+
+
+def align(n):
+    return (n + BLOCK_ALIGNMENT - 1) & ~(BLOCK_ALIGNMENT - 1)
+
+
+def parse_block_header(buf, pos):
+    # returns (type, header size, raw size including the header), or None
+    # when there is not enough data yet
+    if len(buf) < pos + 4:
+        return None
+    type_size = int.from_bytes(buf[pos : pos + 4], "little")
+    btype = type_size >> 30
+    if btype != BLOCK_EXT:
+        return (btype, 4, type_size & 0x3FFFFFFF)
+    if len(buf) < pos + 16:
+        return None
+    return (
+        type_size & 0x3FFFFFFF,
+        16,
+        int.from_bytes(buf[pos + 8 : pos + 16], "little"),
+    )
+
+
+class AdbHeadReader:
+    # incrementally consumes a (possibly compressed) ADB file and stops
+    # as soon as the leading database block is complete, so that callers
+    # can stop downloading; the result is an uncompressed ADB file with
+    # just that block, which is all the metadata there is
+    def __init__(self):
+        self._raw = bytearray()
+        self._decomp = None
+        self._data = bytearray()
+        self.result = None
+
+    def _start(self):
+        magic = bytes(self._raw[:4])
+        if magic == ADB_MAGIC:
+            self._decomp = False
+            rest = self._raw
+        elif magic == b"ADBd":
+            self._decomp = zlib.decompressobj(-15)
+            rest = self._raw[4:]
+        elif magic == b"ADBc":
+            # followed by the compression spec, algorithm and level
+            alg = self._raw[4]
+            if alg == COMP_NONE:
+                self._decomp = False
+            elif alg == COMP_DEFLATE:
+                self._decomp = zlib.decompressobj(-15)
+            else:
+                raise AdbError(f"unsupported compression {alg}")
+            rest = self._raw[6:]
+        else:
+            raise AdbError("not an ADB file")
+        self._raw = None
+        return bytes(rest)
+
+    def feed(self, chunk):
+        # returns True once the database block has been read
+        if self.result is not None:
+            return True
+        if self._decomp is None:
+            self._raw += chunk
+            if len(self._raw) < 6:
+                return False
+            chunk = self._start()
+        if self._decomp:
+            try:
+                chunk = self._decomp.decompress(chunk)
+            except zlib.error as e:
+                raise AdbError(f"decompression failed: {e}")
+        self._data += chunk
+        return self._check()
+
+    def _check(self):
+        data = self._data
+        if len(data) < 8:
+            return False
+        if data[:4] != ADB_MAGIC:
+            raise AdbError("bad ADB magic")
+        hdr = parse_block_header(data, 8)
+        if hdr is None:
+            return False
+        btype, hdrsize, rawsize = hdr
+        if btype != BLOCK_ADB or rawsize < hdrsize:
+            raise AdbError("first block is not a database block")
+        end = 8 + rawsize
+        if len(data) < end:
+            return False
+        self.result = bytes(data[:end]).ljust(8 + align(rawsize), b"\0")
+        self._data = None
+        return True
+
+
+# value encoding, the type lives in the top 4 bits of a 32-bit value
+TYPE_MASK = 0xF0000000
+VALUE_MASK = 0x0FFFFFFF
+
+TYPE_SPECIAL = 0x00000000
+TYPE_INT = 0x10000000
+TYPE_INT_32 = 0x20000000
+TYPE_INT_64 = 0x30000000
+TYPE_BLOB_8 = 0x80000000
+TYPE_BLOB_16 = 0x90000000
+TYPE_BLOB_32 = 0xA0000000
+TYPE_ARRAY = 0xD0000000
+TYPE_OBJECT = 0xE0000000
+
+VAL_NULL = 0
+
+# dependency match flags
+VERSION_EQUAL = 1
+VERSION_LESS = 2
+VERSION_GREATER = 4
+VERSION_FUZZY = 8
+VERSION_CONFLICT = 16
+
+VERSION_OPS = {
+    VERSION_LESS: "<",
+    VERSION_LESS | VERSION_EQUAL: "<=",
+    VERSION_LESS | VERSION_EQUAL | VERSION_FUZZY: "<~",
+    VERSION_EQUAL | VERSION_FUZZY: "~",
+    VERSION_FUZZY: "~",
+    VERSION_EQUAL: "=",
+    VERSION_GREATER | VERSION_EQUAL: ">=",
+    VERSION_GREATER | VERSION_EQUAL | VERSION_FUZZY: ">~",
+    VERSION_GREATER: ">",
+    VERSION_LESS | VERSION_GREATER: "><",
+    VERSION_LESS | VERSION_GREATER | VERSION_EQUAL: "",
+}
+
+
+class AdbReader:
+    def __init__(self, data):
+        self.data = data
+
+    def _get(self, offs, size):
+        if offs + size > len(self.data):
+            raise AdbError("value out of bounds")
+        return self.data[offs : offs + size]
+
+    def uint(self, offs, size):
+        return int.from_bytes(self._get(offs, size), "little")
+
+    def integer(self, val):
+        vtype = val & TYPE_MASK
+        if vtype == TYPE_INT:
+            return val & VALUE_MASK
+        if vtype == TYPE_INT_32:
+            return self.uint(val & VALUE_MASK, 4)
+        if vtype == TYPE_INT_64:
+            return self.uint(val & VALUE_MASK, 8)
+        raise AdbError(f"expected an integer, got {val:#x}")
+
+    def blob(self, val):
+        vtype = val & TYPE_MASK
+        offs = val & VALUE_MASK
+        if vtype == TYPE_BLOB_8:
+            lsize = 1
+        elif vtype == TYPE_BLOB_16:
+            lsize = 2
+        elif vtype == TYPE_BLOB_32:
+            lsize = 4
+        else:
+            raise AdbError(f"expected a blob, got {val:#x}")
+        return self._get(offs + lsize, self.uint(offs, lsize))
+
+    def slots(self, val, vtype):
+        # objects and arrays are a slot count (including the count itself)
+        # followed by the values, objects indexed by field id
+        if val & TYPE_MASK != vtype:
+            raise AdbError(f"expected a container, got {val:#x}")
+        offs = val & VALUE_MASK
+        num = self.uint(offs, 4)
+        if num == 0:
+            return []
+        raw = self._get(offs, num * 4)
+        return [
+            int.from_bytes(raw[i : i + 4], "little") for i in range(4, len(raw), 4)
+        ]
+
+
+# scalar kinds, producing the same text apk adbdump prints
+
+
+def scalar_string(rd, val):
+    return rd.blob(val).decode(errors="replace")
+
+
+def scalar_hexblob(rd, val):
+    return rd.blob(val).hex()
+
+
+def scalar_int(rd, val):
+    return str(rd.integer(val))
+
+
+def scalar_oct(rd, val):
+    return f"{rd.integer(val):o}"
+
+
+def scalar_hsize(rd, val):
+    units = ["B", "KiB", "MiB", "GiB", "TiB"]
+    size = rd.integer(val)
+    i = 0
+    while size >= 10000 and i < len(units) - 1:
+        size //= 1024
+        i += 1
+    return f"{size} {units[i]}"
+
+
+def scalar_dependency(rd, val):
+    fields = rd.slots(val, TYPE_OBJECT)
+    fields += [VAL_NULL] * (3 - len(fields))
+    name, ver, match = fields[0:3]
+    if name == VAL_NULL:
+        raise AdbError("dependency without a name")
+    name = scalar_string(rd, name)
+    mask = rd.integer(match) if match != VAL_NULL else 0
+    if mask == 0:
+        mask = VERSION_EQUAL
+    prefix = "!" if mask & VERSION_CONFLICT else ""
+    if ver == VAL_NULL:
+        return f"{prefix}{name}"
+    op = VERSION_OPS.get(mask & ~VERSION_CONFLICT, "?")
+    return f"{prefix}{name}{op}{scalar_string(rd, ver)}"
+
+
+# schemas, objects are dicts of field id -> (name, kind) and arrays are
+# a single item kind in a list
+
+SCHEMA_DEPENDENCIES = [scalar_dependency]
+
+SCHEMA_PKGINFO = {
+    1: ("name", scalar_string),
+    2: ("version", scalar_string),
+    3: ("unique-id", scalar_hexblob),
+    4: ("description", scalar_string),
+    5: ("arch", scalar_string),
+    6: ("license", scalar_string),
+    7: ("origin", scalar_string),
+    8: ("maintainer", scalar_string),
+    9: ("url", scalar_string),
+    10: ("repo-commit", scalar_hexblob),
+    11: ("build-time", scalar_int),
+    12: ("installed-size", scalar_hsize),
+    13: ("file-size", scalar_hsize),
+    14: ("provider-priority", scalar_int),
+    15: ("depends", SCHEMA_DEPENDENCIES),
+    16: ("provides", SCHEMA_DEPENDENCIES),
+    17: ("replaces", SCHEMA_DEPENDENCIES),
+    18: ("install-if", SCHEMA_DEPENDENCIES),
+    19: ("recommends", SCHEMA_DEPENDENCIES),
+    20: ("layer", scalar_int),
+    21: ("tags", [scalar_string]),
+}
+
+SCHEMA_ACL = {
+    1: ("mode", scalar_oct),
+    2: ("user", scalar_string),
+    3: ("group", scalar_string),
+    4: ("xattrs", [scalar_hexblob]),
+}
+
+SCHEMA_FILE = {
+    1: ("name", scalar_string),
+    2: ("acl", SCHEMA_ACL),
+    3: ("size", scalar_int),
+    4: ("mtime", scalar_int),
+    5: ("hash", scalar_hexblob),
+    6: ("target", scalar_hexblob),
+}
+
+SCHEMA_DIR = {
+    1: ("name", scalar_string),
+    2: ("acl", SCHEMA_ACL),
+    3: ("files", [SCHEMA_FILE]),
+}
+
+SCHEMA_SCRIPTS = {
+    1: ("fetch", scalar_string),
+    2: ("pre-install", scalar_string),
+    3: ("post-install", scalar_string),
+    4: ("pre-deinstall", scalar_string),
+    5: ("post-deinstall", scalar_string),
+    6: ("pre-upgrade", scalar_string),
+    7: ("post-upgrade", scalar_string),
+}
+
+SCHEMAS = {
+    b"indx": {
+        1: ("description", scalar_string),
+        2: ("packages", [SCHEMA_PKGINFO]),
+    },
+    b"pckg": {
+        1: ("info", SCHEMA_PKGINFO),
+        2: ("paths", [SCHEMA_DIR]),
+        3: ("scripts", SCHEMA_SCRIPTS),
+        4: ("triggers", [scalar_string]),
+        5: ("replaces-priority", scalar_int),
+    },
+}
+
+
+def decode_value(rd, val, kind):
+    if isinstance(kind, dict):
+        return decode_object(rd, val, kind)
+    if isinstance(kind, list):
+        return [decode_value(rd, v, kind[0]) for v in rd.slots(val, TYPE_ARRAY)]
+    return kind(rd, val)
+
+
+def decode_object(rd, val, schema, only=None):
+    # null fields are left out, like adbdump does; fields we do not know
+    # about are an error so that the caller can fall back to adbdump
+    result = {}
+    for fid, fval in enumerate(rd.slots(val, TYPE_OBJECT), 1):
+        if fval == VAL_NULL:
+            continue
+        field = schema.get(fid, None)
+        if field is None:
+            if only is not None:
+                continue
+            raise AdbError(f"unknown field {fid}")
+        name, kind = field
+        if only is not None and name != only:
+            continue
+        result[name] = decode_value(rd, fval, kind)
+    return result
+
+
+def open_adb(data):
+    # returns a reader for the database block, the root value and schema
+    reader = AdbHeadReader()
+    if not reader.feed(data):
+        raise AdbError("truncated ADB file")
+    head = reader.result
+    schema = SCHEMAS.get(head[4:8], None)
+    if schema is None:
+        raise AdbError(f"unknown schema {head[4:8]!r}")
+    btype, hdrsize, rawsize = parse_block_header(head, 8)
+    payload = head[8 + hdrsize : 8 + rawsize]
+    if len(payload) < 8:
+        raise AdbError("database block too short")
+    # compat version, version, reserved and the root value
+    if payload[0] != 0:
+        raise AdbError(f"unsupported compat version {payload[0]}")
+    rd = AdbReader(payload)
+    return rd, rd.uint(4, 4), schema
+
+
+def decode(data, root=None):
+    # decodes a whole ADB file into the nested dicts and lists that the
+    # text output of apk adbdump parses into; root limits the result to
+    # one top-level field
+    rd, val, schema = open_adb(data)
+    return decode_object(rd, val, schema, root)
+
+
+def iter_decode(data, root):
+    # yields the items of the top-level list root one at a time
+    rd, val, schema = open_adb(data)
+    for fid, fval in enumerate(rd.slots(val, TYPE_OBJECT), 1):
+        name, kind = schema.get(fid, (None, None))
+        if name != root or fval == VAL_NULL:
+            continue
+        if not isinstance(kind, list):
+            raise AdbError(f"{root} is not a list")
+        for item in rd.slots(fval, TYPE_ARRAY):
+            yield decode_value(rd, item, kind[0])
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+
+    with open(sys.argv[1], "rb") as inf:
+        json.dump(decode(inf.read()), sys.stdout, indent=2)
@@ -0,0 +1,210 @@
+import sys
+from functools import lru_cache
+
+# a port of the version ordering of apk-tools 3 (src/version.c), so that
+# we do not have to spawn `apk version -t` for every comparison
+
+LESS = "<"
+EQUAL = "="
+GREATER = ">"
+
+# token types, in the order apk uses for tie-breaking
+TOKEN_FIRST_DIGIT = 0
+TOKEN_DIGIT = 1
+TOKEN_LETTER = 2
+TOKEN_SUFFIX = 3
+TOKEN_SUFFIX_NO = 4
+TOKEN_COMMIT_HASH = 5
+TOKEN_REVISION_NO = 6
+TOKEN_END = 7
+TOKEN_INVALID = 8
+
+# pre-release suffixes sort before the bare version, the others after
+SUFFIXES = {
+    "alpha": -4,
+    "beta": -3,
+    "pre": -2,
+    "rc": -1,
+    "cvs": 1,
+    "svn": 2,
+    "git": 3,
+    "hg": 4,
+    "p": 5,
+}
+
+HEXDIGITS = "0123456789abcdefABCDEF"
+
+
+def _span(ver, pos, chars):
+    end = pos
+    while end < len(ver) and ver[end] in chars:
+        end += 1
+    return end
+
+
+def _is_digit(c):
+    return "0" <= c <= "9"
+
+
+def _is_lower(c):
+    return "a" <= c <= "z"
+
+
+def tokenize(ver):
+    # yields (token, value) where value is the raw string of the token,
+    # or the suffix weight for suffixes; terminates with END or INVALID
+    token = TOKEN_FIRST_DIGIT
+    pos = _span(ver, 0, "0123456789")
+    if pos == 0:
+        yield (TOKEN_INVALID, None)
+        return
+    yield (token, ver[:pos])
+    while True:
+        if pos >= len(ver):
+            yield (TOKEN_END, None)
+            return
+        c = ver[pos]
+        if _is_lower(c):
+            if token > TOKEN_DIGIT:
+                break
+            token = TOKEN_LETTER
+            value = c
+            pos += 1
+        elif c == ".":
+            if token > TOKEN_DIGIT:
+                break
+            end = _span(ver, pos + 1, "0123456789")
+            if end == pos + 1:
+                break
+            token = TOKEN_DIGIT
+            value = ver[pos + 1 : end]
+            pos = end
+        elif c == "_":
+            if token > TOKEN_SUFFIX_NO:
+                break
+            end = pos + 1
+            while end < len(ver) and _is_lower(ver[end]):
+                end += 1
+            value = SUFFIXES.get(ver[pos + 1 : end], None)
+            if value is None:
+                break
+            token = TOKEN_SUFFIX
+            pos = end
+        elif _is_digit(c):
+            if token != TOKEN_SUFFIX:
+                break
+            end = _span(ver, pos, "0123456789")
+            token = TOKEN_SUFFIX_NO
+            value = ver[pos:end]
+            pos = end
+        elif c == "~":
+            if token >= TOKEN_COMMIT_HASH:
+                break
+            end = _span(ver, pos + 1, HEXDIGITS)
+            if end == pos + 1:
+                break
+            token = TOKEN_COMMIT_HASH
+            value = ver[pos + 1 : end]
+            pos = end
+        elif c == "-":
+            if token >= TOKEN_REVISION_NO or not ver.startswith("-r", pos):
+                break
+            end = _span(ver, pos + 2, "0123456789")
+            if end == pos + 2:
+                break
+            token = TOKEN_REVISION_NO
+            value = ver[pos + 2 : end]
+            pos = end
+        else:
+            break
+        yield (token, value)
+    yield (TOKEN_INVALID, None)
+
+
+def _cmp(a, b):
+    if a < b:
+        return LESS
+    if a > b:
+        return GREATER
+    return EQUAL
+
+
+def _token_cmp(token, av, bv):
+    if token == TOKEN_DIGIT and (av[0] == "0" or bv[0] == "0"):
+        # leading zeroes mean a raw string comparison, like gentoo
+        return _cmp(av, bv)
+    if token in (
+        TOKEN_FIRST_DIGIT,
+        TOKEN_DIGIT,
+        TOKEN_SUFFIX_NO,
+        TOKEN_REVISION_NO,
+    ):
+        return _cmp(int(av), int(bv))
+    return _cmp(av, bv)
+
+
+@lru_cache(maxsize=65536)
+def compare(a, b, fuzzy=False):
+    # returns LESS, EQUAL or GREATER like `apk version -t a b` does
+    ta = tokenize(a)
+    tb = tokenize(b)
+    while True:
+        at, av = next(ta)
+        bt, bv = next(tb)
+        if at != bt or at >= TOKEN_END:
+            break
+        r = _token_cmp(at, av, bv)
+        if r != EQUAL:
+            return r
+    # both ended or both invalid at the same spot, or fuzzy prefix match
+    if at == bt or (fuzzy and bt == TOKEN_END):
+        return EQUAL
+    # leading components are equal, so the longer version is greater
+    # unless it continues with a pre-release suffix
+    if at == TOKEN_SUFFIX and av < 0:
+        return LESS
+    if bt == TOKEN_SUFFIX and bv < 0:
+        return GREATER
+    if at > bt:
+        return LESS
+    if bt > at:
+        return GREATER
+    return EQUAL
+
+
+# operators as stored in the depends table, see parse_version_operator()
+OPERATORS = {
+    "<": (LESS,),
+    "<=": (LESS, EQUAL),
+    "=": (EQUAL,),
+    ">=": (GREATER, EQUAL),
+    ">": (GREATER,),
+    "~": (EQUAL,),
+    "~=": (EQUAL,),
+    "=~": (EQUAL,),
+}
+
+
+def satisfies(ver, op, depver):
+    # whether a package or provide of version ver matches a dependency
+    # with the given operator and version
+    if op is None or depver is None:
+        return True
+    if op == "><":
+        # checksum pinning, there is nothing to compare against
+        return True
+    if ver is None:
+        # unversioned provides never satisfy versioned dependencies
+        return False
+    matches = OPERATORS.get(op, None)
+    if matches is None:
+        return False
+    return compare(ver, depver, "~" in op) in matches
+
+
+if __name__ == "__main__":
+    # same interface as `apk version -t`, handy for checking against apk
+    if len(sys.argv) != 3:
+        print(f"usage: {sys.argv[0]} VERSION1 VERSION2", file=sys.stderr)
+        sys.exit(1)
+    print(compare(sys.argv[1], sys.argv[2]))
@@ -1,12 +1,22 @@
 import atexit
 import os
+import sys
+import json
+import base64
+import bisect
+import hashlib
 import pathlib
 import sqlite3
-import subprocess
+import time
+import threading
+import collections
 import configparser
 from math import ceil
 
-from flask import Flask, render_template, redirect, url_for, g, request, abort, send_file
+from flask import Flask, render_template, redirect, url_for, g, request, abort, send_file, stream_with_context
+from flask import has_request_context, before_render_template, template_rendered
+
+import export
 
 app = Flask(__name__)
 application = app
@@ -26,10 +36,6 @@ def get_repos():
     return config.get('repository', 'repos').split(',')
 
 
-def get_apk():
-    return config.get('settings', 'apk', fallback = 'apk')
-
-
 def get_apkindex_cache():
     return pathlib.Path(config.get('settings', 'apkindex-cache', fallback = 'apkindex_cache'))
 
@@ -45,29 +51,530 @@ def get_settings():
     }
 
 
-def open_databases():
-    db = {}
-    db_dir = config.get('database', 'path')
-    for branch in config.get('repository', 'branches').split(','):
-        db_file = os.path.join(db_dir, f"cports-{branch}.db")
-        db[branch] = sqlite3.connect(db_file)
-        cur = db[branch].cursor()
-        cur.execute("PRAGMA synchronous = NORMAL")
+def get_db_path(branch):
+    return os.path.join(config.get('database', 'path'), f"cports-{branch}.db")
+
+
+class TimedCursor(sqlite3.Cursor):
+    # a query is timed from execute() until its rows run out, the next
+    # execute() or close(), fetching its rows included, and is accounted
+    # to the function that ran it; whatever is left is recorded at the end
+    # of the request, never from a finalizer, since recording takes locks
+    _query = None
+    _elapsed = 0.0
+
+    def _done(self):
+        if self._query is not None:
+            record_timing('query', self._query, self._elapsed)
+            self._query = None
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self._elapsed += time.perf_counter() - start
+
+    def execute(self, sql, parameters=()):
+        self._done()
+        self._query = sys._getframe(1).f_code.co_name
+        self._elapsed = 0.0
+        if has_request_context():
+            g.setdefault('_cursors', set()).add(self)
+        return self._timed(super().execute, sql, parameters)
+
+    def fetchone(self):
+        row = self._timed(super().fetchone)
+        if row is None:
+            self._done()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        rows = self._timed(super().fetchmany, size)
+        if len(rows) < size:
+            self._done()
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(super().fetchall)
+        self._done()
+        return rows
+
+    def __next__(self):
+        try:
+            return self._timed(super().__next__)
+        except StopIteration:
+            self._done()
+            raise
+
+    def close(self):
+        self._done()
+        super().close()
+
+
+def finish_cursors():
+    for cur in g.pop('_cursors', ()):
+        cur._done()
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+class DatabasePool:
+    # long-lived read-only connections, one set per worker (and thread),
+    # so that the sqlite page cache survives across requests
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connections(self):
+        conns = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+        return conns
+
+    def _open(self, db_file):
+        conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, factory=TimedConnection)
+        # untimed, the pragmas are not queries of any page
+        cur = conn.cursor(sqlite3.Cursor)
         cur.execute("PRAGMA cache_size = 100000")  # sized in pages
         cur.execute("PRAGMA temp_store = memory")
         cur.execute("PRAGMA busy_timeout = 3000")  # milliseconds
+        mmap_size = config.getint('database', 'mmap-size', fallback=0)
+        if mmap_size > 0:
+            cur.execute(f"PRAGMA mmap_size = {mmap_size}")
+        return conn
+
+    def connection(self, branch):
+        db_file = get_db_path(branch)
+        st = os.stat(db_file)
+        ident = (st.st_dev, st.st_ino)
+        conns = self._connections()
+        conn, oident = conns.get(branch, (None, None))
+        if conn is not None and oident == ident:
+            return conn
+        # first use in this worker, or the file got replaced under us
+        if conn is not None:
+            conn.close()
+        conn = self._open(db_file)
+        conns[branch] = (conn, ident)
+        return conn
+
+    def close(self):
+        conns = self._connections()
+        for conn, ident in conns.values():
+            conn.close()
+        conns.clear()
+
+
+db_pool = DatabasePool()
+
+
+class ResponseCache:
+    # rendered pages shared by all workers through an sqlite file, keyed
+    # on the branch generation so that an update invalidates them; least
+    # recently used entries are evicted beyond the configured size
+    def __init__(self):
+        self._local = threading.local()
+        self._stats = collections.Counter()
+        self._stats_flushed = time.monotonic()
+
+    def _path(self):
+        return config.get('database', 'response-cache', fallback=None)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path(), isolation_level=None)
+            # a worker that loses the race to switch to WAL tries again on
+            # its next lookup
+            try:
+                cur = conn.cursor()
+                # a busy cache is skipped rather than waited for
+                cur.execute("PRAGMA busy_timeout = 100")
+                cur.execute("PRAGMA journal_mode = WAL")
+                cur.execute("PRAGMA synchronous = OFF")
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        branch TEXT,
+                        generation INTEGER,
+                        mimetype TEXT,
+                        body BLOB,
+                        size INTEGER,
+                        used REAL
+                    )
+                """)
+                cur.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used)")
+                cur.execute("CREATE INDEX IF NOT EXISTS responses_generation ON responses (branch, generation)")
+                cur.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._local.conn = conn
+        return conn
+
+    def enabled(self):
+        return self._path() is not None
+
+    def _count(self, name):
+        # counters are kept per worker and added up in the file now and then
+        self._stats[name] += 1
+        if time.monotonic() - self._stats_flushed < 10:
+            return
+        self.flush()
+
+    def flush(self):
+        stats, self._stats = self._stats, collections.Counter()
+        self._stats_flushed = time.monotonic()
+        if not stats:
+            return
+        sql = """
+            INSERT INTO stats (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+        """
+        try:
+            self._conn().cursor().executemany(sql, list(stats.items()))
+        except sqlite3.Error:
+            pass
+
+    def get(self, key):
+        try:
+            cur = self._conn().cursor()
+            cur.execute("SELECT mimetype, body, used FROM responses WHERE key = ?", [key])
+            row = cur.fetchone()
+            if row is None:
+                self._count('misses')
+                return None
+            mimetype, body, used = row
+            # recency only needs to be coarse, which saves most writes
+            now = time.time()
+            if now - used > 60:
+                cur.execute("UPDATE responses SET used = ? WHERE key = ?", [now, key])
+        except sqlite3.Error:
+            self._count('errors')
+            return None
+        self._count('hits')
+        return mimetype, body
+
+    def put(self, key, branch, generation, mimetype, body):
+        max_size = config.getint('database', 'response-cache-size', fallback=64 * 1024 * 1024)
+        try:
+            cur = self._conn().cursor()
+        except sqlite3.Error:
+            self._count('errors')
+            return
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            # entries of older generations can never be hit again
+            cur.execute("DELETE FROM responses WHERE branch = ? AND generation < ?", [branch, generation])
+            cur.execute("""
+                INSERT OR REPLACE INTO responses (key, branch, generation, mimetype, body, size, used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, [key, branch, generation, mimetype, body, len(body), time.time()])
+            cur.execute("SELECT coalesce(sum(size), 0) FROM responses")
+            excess = cur.fetchone()[0] - max_size
+            if excess > 0:
+                cur.execute("SELECT key, size FROM responses ORDER BY used")
+                evict = []
+                for ekey, size in cur.fetchall():
+                    if excess <= 0:
+                        break
+                    evict.append([ekey])
+                    excess -= size
+                cur.executemany("DELETE FROM responses WHERE key = ?", evict)
+                self._stats['evictions'] += len(evict)
+            cur.execute("COMMIT")
+        except sqlite3.Error:
+            self._count('errors')
+            try:
+                cur.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        # counters of all workers, of which the others may be up to 10
+        # seconds behind; None when the file cannot be read
+        self.flush()
+        try:
+            cur = self._conn().cursor()
+            cur.execute("SELECT name, value FROM stats")
+            result = dict(cur.fetchall())
+            cur.execute("SELECT count(*), coalesce(sum(size), 0) FROM responses")
+            result['entries'], result['size'] = cur.fetchone()
+        except sqlite3.Error:
+            self._count('errors')
+            return None
+        return result
+
+    def close(self):
+        self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+response_cache = ResponseCache()
+
+
+class Metrics:
+    # histograms of request, query and template render times; every worker
+    # adds up its own in memory and into a shared sqlite file now and then,
+    # which /metrics reads back for the totals of all workers
+    BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._flushed = time.monotonic()
+
+    def _path(self):
+        return config.get('database', 'metrics', fallback=None)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self._path(), isolation_level=None)
+            try:
+                cur = conn.cursor()
+                cur.execute("PRAGMA busy_timeout = 100")
+                cur.execute("PRAGMA journal_mode = WAL")
+                cur.execute("PRAGMA synchronous = OFF")
+                # counts and sums per bucket, the last bucket is +Inf
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS histograms (
+                        kind TEXT,
+                        name TEXT,
+                        bucket INTEGER,
+                        count INTEGER,
+                        sum REAL,
+                        PRIMARY KEY (kind, name, bucket)
+                    )
+                """)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._local.conn = conn
+        return conn
+
+    def enabled(self):
+        return self._path() is not None
+
+    def observe(self, kind, name, seconds):
+        if not self.enabled():
+            return
+        key = (kind, name, bisect.bisect_left(self.BUCKETS, seconds))
+        with self._lock:
+            entry = self._pending.setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            if time.monotonic() - self._flushed < 10:
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.monotonic()
+        if not pending:
+            return
+        sql = """
+            INSERT INTO histograms (kind, name, bucket, count, sum) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (kind, name, bucket) DO UPDATE SET
+                count = count + excluded.count,
+                sum = sum + excluded.sum
+        """
+        try:
+            self._conn().cursor().executemany(sql, [[*key, *entry] for key, entry in pending.items()])
+        except sqlite3.Error:
+            pass
+
+    def histograms(self):
+        # kind -> name -> (count per bucket, sum) of all workers, of which
+        # the others may be up to 10 seconds behind
+        self.flush()
+        try:
+            cur = self._conn().cursor()
+            cur.execute("SELECT kind, name, bucket, count, sum FROM histograms")
+            rows = cur.fetchall()
+        except sqlite3.Error:
+            return {}
+        result = {}
+        for kind, name, bucket, count, total in rows:
+            counts, prev = result.setdefault(kind, {}).get(name, ([0] * (len(self.BUCKETS) + 1), 0.0))
+            counts[bucket] += count
+            result[kind][name] = (counts, prev + total)
+        return result
+
+    def close(self):
+        self.flush()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+metrics = Metrics()
+
+
+def record_timing(kind, name, seconds):
+    # kept per request for the Server-Timing header, and in the histograms
+    if has_request_context():
+        timings = g.setdefault('_timings', collections.Counter())
+        timings[(kind, name)] += seconds
+    metrics.observe(kind, name, seconds)
+
+
+@app.before_request
+def start_timing():
+    g._request_start = time.perf_counter()
+
+
+@before_render_template.connect_via(app)
+def start_render_timing(sender, template, context, **extra):
+    g._render_start = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def end_render_timing(sender, template, context, **extra):
+    record_timing('render', template.name, time.perf_counter() - g.pop('_render_start'))
+
+
+@app.after_request
+def add_server_timing(resp):
+    # a streamed body is still to come, so that is not part of the total
+    start = g.get('_request_start', None)
+    if start is None:
+        return resp
+    total = time.perf_counter() - start
+    metrics.observe('request', request.endpoint or 'none', total)
+    if not resp.is_streamed:
+        finish_cursors()
+    if config.get('settings', 'server-timing', fallback='yes') == 'no':
+        return resp
+    timings = g.get('_timings', {})
+    entries = []
+    db = 0.0
+    for (kind, name), seconds in timings.items():
+        if kind == 'query':
+            db += seconds
+            entries.append(f"{name};dur={seconds * 1000:.3f}")
+        else:
+            entries.append(f'{kind};desc="{name}";dur={seconds * 1000:.3f}')
+    entries.append(f"db;dur={db * 1000:.3f}")
+    entries.append(f"total;dur={total * 1000:.3f}")
+    resp.headers['Server-Timing'] = ", ".join(entries)
+    return resp
+
+
+@app.teardown_request
+def finish_request_timing(exc):
+    # cursors of a streamed body, which is done by now
+    finish_cursors()
+
 
-    g._db = db
+class RequestDatabases(dict):
+    # branch connections are looked up lazily and pinned for the request
+    def __missing__(self, branch):
+        if branch not in get_branches():
+            raise KeyError(branch)
+        conn = db_pool.connection(branch)
+        self[branch] = conn
+        return conn
 
 
 def get_db():
     db = getattr(g, '_db', None)
     if db is None:
-        open_databases()
-        db = getattr(g, '_db', None)
+        db = g._db = RequestDatabases()
     return db
 
 
+def get_generation(branch):
+    # (generation, unix time) of the last change to a branch database,
+    # see bump_generation() in the updater; None if it cannot tell
+    if branch not in get_branches():
+        return None
+    cur = get_db()[branch].cursor()
+    try:
+        cur.execute("SELECT key, value FROM meta WHERE key IN ('generation', 'updated')")
+    except sqlite3.OperationalError:
+        return None
+    meta = dict(cur.fetchall())
+    if 'generation' not in meta:
+        return None
+    return meta['generation'], meta.get('updated')
+
+
+def get_code_version():
+    # pages also depend on the code, templates and configuration, so
+    # a deployment must not be answered from copies made by the last one
+    version = getattr(get_code_version, 'version', None)
+    if version is None:
+        root = pathlib.Path(__file__).parent
+        h = hashlib.sha256()
+        for path in [root / 'app.py', root / 'config.ini', *sorted((root / 'templates').iterdir())]:
+            if path.is_file():
+                h.update(path.read_bytes())
+        version = get_code_version.version = h.hexdigest()[:16]
+    return version
+
+
+def cached_response(branch, store=True):
+    # returns a response for the page without running any of its queries:
+    # 304 if the client already has the current version, or the page as
+    # rendered earlier by any worker; otherwise the page gets validators
+    # and is cached by add_cache_headers()
+    generation = get_generation(branch)
+    if generation is None:
+        return None
+    g._validators = (f"{get_code_version()}-{branch}-{generation[0]}", generation[1])
+    resp = app.response_class()
+    add_cache_headers(resp)
+    resp.make_conditional(request)
+    if resp.status_code == 304:
+        return resp
+
+    if not store or not response_cache.enabled():
+        return None
+    key = json.dumps([
+        request.endpoint,
+        request.view_args,
+        sorted(request.args.items(multi=True)),
+        branch,
+        generation[0],
+        get_code_version(),
+    ])
+    key = hashlib.sha256(key.encode()).hexdigest()
+    cached = response_cache.get(key)
+    if cached is None:
+        g._cache_entry = (key, branch, generation[0])
+        return None
+    mimetype, body = cached
+    return app.response_class(body, mimetype=mimetype)
+
+
+@app.after_request
+def add_cache_headers(resp):
+    validators = getattr(g, '_validators', None)
+    if validators is None or resp.status_code not in (200, 304):
+        return resp
+    etag, updated = validators
+    resp.set_etag(etag)
+    if updated is not None:
+        resp.last_modified = updated
+    resp.headers['Cache-Control'] = config.get('settings', 'cache-control', fallback='no-cache')
+    entry = getattr(g, '_cache_entry', None)
+    if entry is not None and resp.status_code == 200 and not resp.is_streamed:
+        g._cache_entry = None
+        response_cache.put(*entry, resp.mimetype, resp.get_data())
+    return resp
+
+
 def get_maintainers(branch):
     db = get_db()
     cur = db[branch].cursor()
@@ -76,16 +583,58 @@ def get_maintainers(branch):
     return map(lambda x: x[0], result)
 
 
-def get_filter(name, arch, repo, maintainer=None, origin=None, file=None, path=None, provides=False):
+def get_contents_source(file, path, name=None, stream=False):
+    # patterns with a leading wildcard cannot use the b-tree indexes, so
+    # drive the query from the trigram index of that column instead; the
+    # cross join keeps sqlite from putting it in an inner loop, where it
+    # would run the whole match once per row. a package given by its name
+    # has few enough files to go through, which is far quicker than any
+    # match over all of them. a stream of all matches goes along the unique
+    # index of the paths instead, so that only the rows of one directory
+    # are sorted at a time rather than the whole result before its first
+    # row. returns the joined tables and the columns to filter on
+    def leading_wildcard(pattern):
+        return pattern is not None and pattern[:1] in ("*", "?", "[")
+
+    by_name = name and not any(c in name for c in "*?[")
+    if stream and not by_name:
+        return """
+            dirs
+            CROSS JOIN files ON files.did = dirs.id
+            CROSS JOIN packages ON packages.fid = files.fid
+        """, "files.file", "dirs.path"
+    if leading_wildcard(file) and not by_name:
+        return """
+            files_fts
+            CROSS JOIN files ON files.id = files_fts.rowid
+            JOIN dirs ON dirs.id = files.did
+            JOIN packages ON packages.fid = files.fid
+        """, "files_fts.file", "dirs.path"
+    if leading_wildcard(path) and not by_name:
+        return """
+            dirs_fts
+            CROSS JOIN dirs ON dirs.id = dirs_fts.rowid
+            JOIN files ON files.did = dirs.id
+            JOIN packages ON packages.fid = files.fid
+        """, "files.file", "dirs_fts.path"
+    return """
+        packages
+        JOIN files ON files.fid = packages.fid
+        JOIN dirs ON dirs.id = files.did
+    """, "files.file", "dirs.path"
+
+
+def get_filter(name, arch, repo, maintainer=None, origin=None, file=None, path=None, provides=False,
+               file_column="files.file", path_column="dirs.path"):
     filter_fields = {
         "packages.name": name,
         "packages.arch": arch,
         "packages.repo": repo,
         "maintainer.name": maintainer,
-        "files.file": file,
-        "files.path": path
+        file_column: file,
+        path_column: path
     }
-    glob_fields = ["packages.name", "files.file", "files.path"]
+    glob_fields = ["packages.name", file_column, path_column]
 
     where = []
     args = []
@@ -109,32 +658,140 @@ def get_filter(name, arch, repo, maintainer=None, origin=None, file=None, path=N
     return where, args
 
 
+def encode_cursor(values):
+    # opaque keyset pagination token for the sort key of the last row
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+# types of the values in the cursors of get_packages_cursor() and
+# get_contents_cursor()
+PACKAGES_CURSOR = (int, str, int)
+CONTENTS_CURSOR = (str, str, int, int)
+
+
+def decode_cursor(token, types):
+    # None unless it is a list of values of exactly the given types, as
+    # anything else would end up as a query parameter
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+    except ValueError:
+        return None
+    if not isinstance(values, list) or len(values) != len(types):
+        return None
+    for value, vtype in zip(values, types):
+        if type(value) is not vtype:
+            return None
+    return values
+
+
+def add_condition(where, cond):
+    if where:
+        return f"{where} AND {cond}"
+    return f"WHERE {cond}"
+
+
 def get_num_packages(branch, name=None, arch=None, repo=None, maintainer=None, origin=None):
+    # returns the count and whether it stopped at the count limit
     db = get_db()
+    cur = db[branch].cursor()
+
+    if name is None or name == "":
+        # no name pattern means the count is just a sum over the facet
+        # counts maintained by the updater
+        where = []
+        args = []
+        for key, value in [("package_counts.repo", repo), ("package_counts.arch", arch),
+                           ("maintainer.name", maintainer)]:
+            if value is None or value == "":
+                continue
+            where.append(f"{key} = ?")
+            args.append(str(value))
+        if origin:
+            where.append("package_counts.is_origin = 1")
+
+        sql = """
+        SELECT coalesce(sum(package_counts.qty), 0)
+        FROM package_counts
+        LEFT JOIN maintainer ON package_counts.maintainer = maintainer.id
+        {}
+        """.format("WHERE " + " AND ".join(where) if where else "")
+
+        cur.execute(sql, args)
+        return cur.fetchone()[0], False
 
     where, args = get_filter(name, arch, repo, maintainer, origin, provides=True)
 
+    # counting stops past the limit, as the exact number does not matter
+    # for pagination that deep
+    count_limit = config.getint('settings', 'count-limit', fallback=0)
+    if count_limit > 0:
+        limit = f"LIMIT {count_limit + 1}"
+    else:
+        limit = ""
+
     sql = """
-    SELECT DISTINCT count(*) as qty
-    FROM packages
-    LEFT JOIN maintainer ON packages.maintainer = maintainer.id
-    LEFT JOIN provides ON provides.pid = packages.id
-    {}
-    """.format(where)
+    SELECT count(*) FROM (
+        SELECT DISTINCT packages.id
+        FROM packages
+        LEFT JOIN maintainer ON packages.maintainer = maintainer.id
+        LEFT JOIN provides ON provides.pid = packages.id
+        {}
+        {}
+    )
+    """.format(where, limit)
 
-    cur = db[branch].cursor()
     cur.execute(sql, args)
     result = cur.fetchone()
-    return result[0]
+    if 0 < count_limit < result[0]:
+        return count_limit, True
+    return result[0], False
 
 
-def get_packages(branch, offset, name=None, arch=None, repo=None, maintainer=None, origin=None):
+def iter_rows(cur):
+    # rows as dicts straight off the cursor, without fetching them all
+    fields = [i[0] for i in cur.description]
+    for row in cur:
+        yield dict(zip(fields, row))
+
+
+def iter_packages(branch, offset=0, name=None, arch=None, repo=None, maintainer=None, origin=None, after=None,
+                  limit=50):
     db = get_db()
 
     where, args = get_filter(name, arch, repo, maintainer, origin, provides=True)
 
+    # provides only matter for the name pattern, and are what can make
+    # a package show up more than once
+    if name:
+        distinct = "DISTINCT"
+        provides = "LEFT JOIN provides ON provides.pid = packages.id"
+    else:
+        distinct = provides = ""
+
+    # with a cursor, seek past the last row of the previous page instead
+    # of skipping over everything before it; the leading bound on its own
+    # is what lets sqlite start the index scan there
+    if after is not None:
+        where = add_condition(where, """packages.build_time <= ? AND (
+            packages.build_time < ? OR (packages.build_time = ? AND (
+                packages.name > ? OR (packages.name = ? AND packages.id > ?)
+            ))
+        )""")
+        args += [after[0], after[0], after[0], after[1], after[1], after[2]]
+        offset = 0
+    if limit is None:
+        limit = ""
+    elif offset:
+        limit = f"LIMIT {int(limit)} OFFSET ?"
+        args.append(offset)
+    else:
+        limit = f"LIMIT {int(limit)}"
+
     sql = """
-    SELECT DISTINCT packages.*, datetime(packages.build_time, 'unixepoch') as build_time,
+    SELECT {} packages.*, datetime(packages.build_time, 'unixepoch') as build_time,
+        packages.build_time as build_timestamp,
         maintainer.name as mname, maintainer.email as memail,
         datetime(flagged.created, 'unixepoch') as flagged
     FROM packages
@@ -142,28 +799,79 @@ def get_packages(branch, offset, name=None, arch=None, repo=None, maintainer=Non
     LEFT JOIN flagged ON packages.origin = flagged.origin
         AND packages.version = flagged.version
         AND packages.repo = flagged.repo
-    LEFT JOIN provides ON provides.pid = packages.id
     {}
-    ORDER BY packages.build_time DESC, packages.name ASC
-    LIMIT 50 OFFSET ?
-    """.format(where)
+    {}
+    ORDER BY packages.build_time DESC, packages.name ASC, packages.id ASC
+    {}
+    """.format(distinct, provides, where, limit)
 
     cur = db[branch].cursor()
-    args.append(offset)
     cur.execute(sql, args)
+    return iter_rows(cur)
 
-    fields = [i[0] for i in cur.description]
-    result = [dict(zip(fields, row)) for row in cur.fetchall()]
-    return result
+
+def get_packages(branch, offset, name=None, arch=None, repo=None, maintainer=None, origin=None, after=None):
+    return list(iter_packages(branch, offset, name, arch, repo, maintainer, origin, after))
+
+
+def get_packages_cursor(packages):
+    if len(packages) < 50:
+        return None
+    last = packages[-1]
+    return encode_cursor([last['build_timestamp'], last['name'], last['id']])
 
 
 def get_package(branch, repo, arch, name):
     db = get_db()
 
+    # everything the package page shows in one statement, with the lists
+    # aggregated to json by sqlite; dependencies are resolved by the
+    # updater, see update_resolved_depends() and resolve_depends()
     sql = """
         SELECT packages.*, datetime(packages.build_time, 'unixepoch') as build_time,
+            packages.build_time as build_timestamp,
             maintainer.name as mname, maintainer.email as memail,
-            datetime(flagged.created, 'unixepoch') as flagged
+            datetime(flagged.created, 'unixepoch') as flagged,
+            (
+                SELECT json_group_array(json_object('name', depname, 'target', name, 'repo', repo, 'arch', arch))
+                FROM (
+                    SELECT rd.depname, pa.name, pa.repo, pa.arch
+                    FROM resolved_depends rd
+                    LEFT JOIN packages pa ON pa.id = rd.target_pid
+                    WHERE rd.pid = packages.id
+                    ORDER BY rd.rowid
+                )
+            ) as depends,
+            (
+                SELECT json_group_array(json_object('name', name, 'repo', repo, 'arch', arch))
+                FROM (
+                    SELECT pa.name, pa.repo, pa.arch
+                    FROM reverse_depends rd
+                    JOIN packages pa ON pa.id = rd.pid
+                    WHERE rd.target_pid = packages.id
+                    ORDER BY pa.name
+                )
+            ) as required_by,
+            (
+                SELECT json_group_array(json_object('name', name, 'repo', repo, 'arch', arch))
+                FROM (
+                    SELECT DISTINCT pa.name, pa.repo, pa.arch
+                    FROM packages pa
+                    WHERE pa.arch = packages.arch AND pa.origin = packages.origin
+                    ORDER BY pa.name
+                )
+            ) as subpackages,
+            (
+                SELECT json_group_array(json_object('name', name, 'operator', operator, 'version', version))
+                FROM install_if
+                WHERE install_if.pid = packages.id
+            ) as install_if,
+            (
+                SELECT json_group_array(json_object('name', name, 'operator', operator, 'version', version))
+                FROM provides
+                WHERE provides.pid = packages.id
+                    AND provides.name != packages.name
+            ) as provides
         FROM packages
         LEFT JOIN maintainer ON packages.maintainer = maintainer.id
         LEFT JOIN flagged ON packages.origin = flagged.origin
@@ -171,30 +879,35 @@ def get_package(branch, repo, arch, name):
         WHERE packages.repo = ?
             AND packages.arch = ?
             AND packages.name = ?
+        LIMIT 1
     """
 
     cur = db[branch].cursor()
     cur.execute(sql, [repo, arch, name])
 
     fields = [i[0] for i in cur.description]
-    alldata = cur.fetchall()
-    if len(alldata) == 0:
+    row = cur.fetchone()
+    if row is None:
         return None
-    result = [dict(zip(fields, row)) for row in alldata]
-    return result[0]
+    result = dict(zip(fields, row))
+    # unresolved dependencies only have a name
+    for key in ['depends', 'required_by', 'subpackages', 'install_if', 'provides']:
+        result[key] = [{k: v for k, v in item.items() if v is not None} for item in json.loads(result[key])]
+    return result
 
 
 def get_num_contents(branch, name=None, arch=None, repo=None, file=None, path=None):
     db = get_db()
 
-    where, args = get_filter(name, arch, repo, file=file, path=path)
+    source, file_column, path_column = get_contents_source(file, path, name)
+    where, args = get_filter(name, arch, repo, file=file, path=path,
+                             file_column=file_column, path_column=path_column)
 
     sql = """
         SELECT count(packages.id)
-        FROM packages
-        JOIN files ON files.pid = packages.id
+        FROM {}
         {}
-    """.format(where)
+    """.format(source, where)
 
     cur = db[branch].cursor()
     cur.execute(sql, args)
@@ -202,180 +915,50 @@ def get_num_contents(branch, name=None, arch=None, repo=None, file=None, path=No
     return result[0]
 
 
-def get_contents(branch, offset, file=None, path=None, name=None, arch=None, repo=None):
+def iter_contents(branch, offset=0, file=None, path=None, name=None, arch=None, repo=None, after=None,
+                  limit=50):
     db = get_db()
 
-    where, args = get_filter(name, arch, repo, maintainer=None, origin=None, file=file, path=path)
+    source, file_column, path_column = get_contents_source(file, path, name, stream=limit is None)
+    where, args = get_filter(name, arch, repo, maintainer=None, origin=None, file=file, path=path,
+                             file_column=file_column, path_column=path_column)
+
+    # file rows are shared between packages, hence the package id too
+    if after is not None:
+        where = add_condition(where, "(dirs.path, files.file, files.id, packages.id) > (?, ?, ?, ?)")
+        args += after
+        offset = 0
+    if limit is None:
+        limit = ""
+    elif offset:
+        limit = f"LIMIT {int(limit)} OFFSET ?"
+        args.append(offset)
+    else:
+        limit = f"LIMIT {int(limit)}"
 
     sql = """
-        SELECT packages.repo, packages.arch, packages.name, files.*
-        FROM packages
-        JOIN files ON files.pid = packages.id
+        SELECT packages.repo, packages.arch, packages.name, packages.id as pid,
+            files.id, files.file, dirs.path
+        FROM {}
+        {}
+        ORDER BY dirs.path, files.file, files.id, packages.id
         {}
-        ORDER BY files.path, files.file
-        LIMIT 50 OFFSET ?
-    """.format(where)
+    """.format(source, where, limit)
 
     cur = db[branch].cursor()
-    args.append(offset)
     cur.execute(sql, args)
-
-    fields = [i[0] for i in cur.description]
-    result = [dict(zip(fields, row)) for row in cur.fetchall()]
-    return result
+    return iter_rows(cur)
 
 
-def get_depends(branch, package_id, arch):
-    db = get_db()
-
-    sql_provides = """
-        SELECT de.name, pa.repo, pa.arch, pa.name, pa.provider_priority, de.name as depname, de.version as depver
-        FROM depends de
-        JOIN provides pr ON de.name = pr.name
-        LEFT JOIN packages pa ON pr.pid = pa.id
-        WHERE de.pid = ? AND pa.arch = ?
-    """
-
-    sql_direct = """
-        SELECT de.name, dp.repo, dp.arch, dp.name, dp.provider_priority, de.name as depname
-        FROM depends de
-        JOIN packages dp ON dp.name = de.name
-        WHERE de.pid = ? AND dp.arch = ?
-    """
-
-    sql_names = """
-        SELECT de.name as depname
-        FROM depends de
-        WHERE de.pid = ?
-    """
+def get_contents(branch, offset, file=None, path=None, name=None, arch=None, repo=None, after=None):
+    return list(iter_contents(branch, offset, file, path, name, arch, repo, after))
 
-    cur = db[branch].cursor()
-    apk_bin = get_apk()
-
-    cur.execute(sql_provides, [package_id, arch])
-    fields = [i[0] for i in cur.description]
-    through_provides = [dict(zip(fields, row)) for row in cur.fetchall()]
-    provides = {}
-    for p in through_provides:
-        depn = p['depname']
-        if depn in provides:
-            pp = provides[depn]
-            cmp = subprocess.run([apk_bin, 'version', '-t', str(pp['depver']), str(p['depver'])], capture_output = True)
-            outs = cmp.stdout.strip().decode()
-            if outs == "<":
-                provides[depn] = p
-            elif outs == "=":
-                oprio = -1
-                nprio = -1
-                if pp['provider_priority'] is not None:
-                    oprio = pp['provider_priority']
-                if p['provider_priority'] is not None:
-                    nprio = p['provider_priority']
-                if int(nprio) > int(oprio):
-                    provides[depn] = p
-        else:
-            provides[depn] = p
-
-    cur.execute(sql_direct, [package_id, arch])
-    fields = [i[0] for i in cur.description]
-    direct_dependency = [dict(zip(fields, row)) for row in cur.fetchall()]
-    direct = {}
-    for p in direct_dependency:
-        direct[p['depname']] = p
 
-
-    cur.execute(sql_names, [package_id])
-    fields = [i[0] for i in cur.description]
-    all_deps = [dict(zip(fields, row)) for row in cur.fetchall()]
-
-    result = []
-    for dep in all_deps:
-        name = dep['depname']
-        dep = None
-        if name in direct:
-            dep = direct[name]
-
-        if name in provides and not dep:
-            dep = provides[name]
-
-        if dep is None:
-            result.append({'name': name})
-        else:
-            result.append({'name': name, 'target': dep['name'], 'repo': dep['repo'], 'arch': dep['arch']})
-
-    return result
-
-
-def get_required_by(branch, package_id, pkgname, arch):
-    db = get_db()
-
-    # TODO: account for version constraints
-    sql = """
-        SELECT DISTINCT packages.* FROM packages
-        LEFT JOIN depends ON depends.pid = packages.id
-        WHERE packages.arch = ? AND (depends.name = ? OR depends.name IN (
-            SELECT name FROM provides WHERE provides.pid = ?
-        ))
-        ORDER BY packages.name
-    """
-
-    cur = db[branch].cursor()
-    cur.execute(sql, [arch, pkgname, package_id])
-
-    fields = [i[0] for i in cur.description]
-    result = [dict(zip(fields, row)) for row in cur.fetchall()]
-    return result
-
-
-def get_subpackages(branch, package_id, arch):
-    db = get_db()
-
-    sql = """
-        SELECT DISTINCT packages.* FROM packages
-        WHERE arch = ? AND origin = ?
-        ORDER BY packages.name
-    """
-
-    cur = db[branch].cursor()
-    cur.execute(sql, [arch, package_id])
-
-    fields = [i[0] for i in cur.description]
-    result = [dict(zip(fields, row)) for row in cur.fetchall()]
-    return result
-
-
-def get_install_if(branch, package_id):
-    db = get_db()
-
-    sql = """
-        SELECT name, operator, version
-        FROM install_if
-        WHERE pid = ?
-    """
-
-    cur = db[branch].cursor()
-    cur.execute(sql, [package_id])
-
-    fields = [i[0] for i in cur.description]
-    result = [dict(zip(fields, row)) for row in cur.fetchall()]
-    return result
-
-
-def get_provides(branch, package_id, pkgname):
-    db = get_db()
-
-    sql = """
-        SELECT name, operator, version
-        FROM provides
-        WHERE pid = ?
-            AND name != ?
-    """
-
-    cur = db[branch].cursor()
-    cur.execute(sql, [package_id, pkgname])
-    fields = [i[0] for i in cur.description]
-    result = [dict(zip(fields, row)) for row in cur.fetchall()]
-    return result
+def get_contents_cursor(contents):
+    if len(contents) < 50:
+        return None
+    last = contents[-1]
+    return encode_cursor([last['path'], last['file'], last['id'], last['pid']])
 
 
 @app.route('/')
@@ -393,6 +976,7 @@ def packages():
     origin = request.args.get('origin')
 
     page = request.args.get('page')
+    after = request.args.get('after')
 
     form = {
         "name": name if name is not None else "",
@@ -404,19 +988,28 @@ def packages():
         "page": int(page) if page is not None else 1
     }
 
+    resp = cached_response(form['branch'])
+    if resp is not None:
+        return resp
+
     branches = get_branches()
     arches = get_arches()
     repos = get_repos()
     maintainers = get_maintainers(branch=form['branch'])
 
     offset = (form['page'] - 1) * 50
+    if after is not None:
+        after = decode_cursor(after, PACKAGES_CURSOR)
+        if after is None:
+            return abort(400)
 
     packages = get_packages(branch=form['branch'], offset=offset, name=name, arch=arch, repo=repo,
                             maintainer=maintainer,
-                            origin=origin)
+                            origin=origin, after=after)
+    next_cursor = get_packages_cursor(packages)
 
-    num_packages = get_num_packages(branch=form['branch'], name=name, arch=arch, repo=repo, maintainer=maintainer,
-                                    origin=origin)
+    num_packages, capped = get_num_packages(branch=form['branch'], name=name, arch=arch, repo=repo,
+                                            maintainer=maintainer, origin=origin)
     pages = ceil(num_packages / 50)
 
     pag_start = form['page'] - 4
@@ -424,7 +1017,8 @@ def packages():
     if pag_start < 0:
         pag_stop += abs(pag_start)
         pag_start = 0
-    pag_stop = min(pag_stop, pages)
+    # past a capped count the pages are only known up to the current one
+    pag_stop = min(pag_stop, max(pages, form['page']) if capped else pages)
 
     return render_template("index.html",
                            **get_settings(),
@@ -435,9 +1029,12 @@ def packages():
                            repos=repos,
                            maintainers=maintainers,
                            packages=packages,
+                           next_cursor=next_cursor,
                            pag_start=pag_start,
                            pag_stop=pag_stop,
-                           pages=pages)
+                           pages=pages,
+                           num_packages=num_packages,
+                           capped=capped)
 
 
 @app.route('/contents')
@@ -450,6 +1047,7 @@ def contents():
     arch = request.args.get('arch')
 
     page = request.args.get('page')
+    after = request.args.get('after')
 
     form = {
         "file": file if file is not None else "",
@@ -461,17 +1059,26 @@ def contents():
         "page": int(page) if page is not None else 1
     }
 
+    resp = cached_response(form['branch'])
+    if resp is not None:
+        return resp
+
     branches = get_branches()
     arches = get_arches()
     repos = get_repos()
 
     offset = (form['page'] - 1) * 50
+    if after is not None:
+        after = decode_cursor(after, CONTENTS_CURSOR)
+        if after is None:
+            return abort(400)
+
     if form['name'] == '' and form['file'] == '' and form['path'] == '':
         contents = []
         num_contents = 0
     else:
         contents = get_contents(branch=form['branch'], offset=offset, file=file, path=path, name=name, arch=arch,
-                                repo=form['repo'])
+                                repo=form['repo'], after=after)
 
         num_contents = get_num_contents(branch=form['branch'], file=file, path=path, name=name, arch=arch, repo=repo)
 
@@ -492,6 +1099,7 @@ def contents():
                            arches=arches,
                            repos=repos,
                            contents=contents,
+                           next_cursor=get_contents_cursor(contents),
                            pag_start=pag_start,
                            pag_stop=pag_stop,
                            pages=pages)
@@ -499,6 +1107,10 @@ def contents():
 
 @app.route('/package/<branch>/<path:repo>/<arch>/<name>')
 def package(branch, repo, arch, name):
+    resp = cached_response(branch)
+    if resp is not None:
+        return resp
+
     package = get_package(branch, repo, arch, name)
 
     if package is None:
@@ -522,11 +1134,11 @@ def package(branch, repo, arch, name):
                                                            buildbot_version=package['version'].replace('.', '_'),
                                                            origin=package['origin'])
 
-    depends = get_depends(branch, package['id'], arch)
-    required_by = get_required_by(branch, package['id'], package['name'], arch)
-    subpackages = get_subpackages(branch, package['origin'], arch)
-    install_if = get_install_if(branch, package['id'])
-    provides = get_provides(branch, package['id'], package['name'])
+    depends = package['depends']
+    required_by = package['required_by']
+    subpackages = package['subpackages']
+    install_if = package['install_if']
+    provides = package['provides']
 
     return render_template("package.html",
                            **get_settings(),
@@ -548,6 +1160,174 @@ def package(branch, repo, arch, name):
                            pkg=package)
 
 
+# package fields as exposed by the api
+API_PACKAGE_FIELDS = ['name', 'version', 'description', 'url', 'license', 'arch', 'repo', 'origin', 'commit',
+                      'size', 'installed_size', 'provider_priority']
+
+
+def api_package(pkg):
+    result = {key: pkg[key] for key in API_PACKAGE_FIELDS}
+    result['build_time'] = pkg['build_timestamp']
+    result['maintainer'] = {'name': pkg['mname'], 'email': pkg['memail']} if pkg['memail'] else None
+    result['flagged'] = pkg['flagged']
+    return result
+
+
+def api_content(row):
+    return {'repo': row['repo'], 'arch': row['arch'], 'name': row['name'], 'path': row['path'],
+            'file': row['file']}
+
+
+def get_api_args(fields):
+    # the filters of an api request, with a 404 for an unknown branch
+    args = {field: request.args.get(field) for field in fields}
+    args['branch'] = request.args.get('branch', config.get('repository', 'default-branch'))
+    if args['branch'] not in get_branches():
+        abort(404)
+    return args
+
+
+def ndjson_response(rows):
+    def generate():
+        for row in rows:
+            yield json.dumps(row) + "\n"
+    return app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/packages')
+def api_packages():
+    args = get_api_args(['name', 'repo', 'arch', 'maintainer', 'origin'])
+
+    resp = cached_response(args['branch'])
+    if resp is not None:
+        return resp
+
+    page = request.args.get('page', '1')
+    after = request.args.get('after')
+    if not page.isdigit() or int(page) < 1:
+        return abort(400)
+    if after is not None:
+        after = decode_cursor(after, PACKAGES_CURSOR)
+        if after is None:
+            return abort(400)
+
+    packages = get_packages(offset=(int(page) - 1) * 50, after=after, **args)
+    total, capped = get_num_packages(**args)
+
+    return {
+        'total': total,
+        'total_capped': capped,
+        'next': get_packages_cursor(packages),
+        'packages': [api_package(pkg) for pkg in packages],
+    }
+
+
+@app.route('/api/packages.ndjson')
+def api_packages_ndjson():
+    args = get_api_args(['name', 'repo', 'arch', 'maintainer', 'origin'])
+
+    resp = cached_response(args['branch'], store=False)
+    if resp is not None:
+        return resp
+
+    # every matching package in a single response, one per line
+    return ndjson_response(map(api_package, iter_packages(limit=None, **args)))
+
+
+@app.route('/api/package/<branch>/<path:repo>/<arch>/<name>')
+def api_package_detail(branch, repo, arch, name):
+    if branch not in get_branches():
+        return abort(404)
+
+    resp = cached_response(branch)
+    if resp is not None:
+        return resp
+
+    package = get_package(branch, repo, arch, name)
+
+    if package is None:
+        return abort(404)
+
+    result = api_package(package)
+    for key in ['depends', 'required_by', 'subpackages', 'install_if', 'provides']:
+        result[key] = package[key]
+    return result
+
+
+@app.route('/api/contents')
+def api_contents():
+    args = get_api_args(['file', 'path', 'name', 'repo', 'arch'])
+
+    resp = cached_response(args['branch'])
+    if resp is not None:
+        return resp
+
+    page = request.args.get('page', '1')
+    after = request.args.get('after')
+    if not page.isdigit() or int(page) < 1:
+        return abort(400)
+    if after is not None:
+        after = decode_cursor(after, CONTENTS_CURSOR)
+        if after is None:
+            return abort(400)
+
+    # like the html page, an unfiltered listing of every file is refused
+    if not (args['name'] or args['file'] or args['path']):
+        return abort(400)
+
+    contents = get_contents(offset=(int(page) - 1) * 50, after=after, **args)
+
+    return {
+        'total': get_num_contents(**args),
+        'next': get_contents_cursor(contents),
+        'contents': [api_content(row) for row in contents],
+    }
+
+
+@app.route('/api/contents.ndjson')
+def api_contents_ndjson():
+    args = get_api_args(['file', 'path', 'name', 'repo', 'arch'])
+
+    if not (args['name'] or args['file'] or args['path']):
+        return abort(400)
+
+    resp = cached_response(args['branch'], store=False)
+    if resp is not None:
+        return resp
+
+    return ndjson_response(map(api_content, iter_contents(limit=None, **args)))
+
+
+@app.route('/export/<branch>/<path:repo>/<arch>')
+def export_packages(branch, repo, arch):
+    if branch not in get_branches() or repo not in get_repos() or arch not in get_arches():
+        return abort(404)
+
+    resp = cached_response(branch, store=False)
+    if resp is not None:
+        return resp
+
+    download_name = f"{branch}_{repo.replace('/', '_')}_{arch}.ndjson.gz"
+
+    # the updater precomputes the exports of every generation
+    exportd = config.get('settings', 'export-dir', fallback=None)
+    generation = get_generation(branch)
+    if exportd and generation is not None:
+        path = export.get_export_path(exportd, branch, repo, arch, generation[0])
+        if path.is_file():
+            return send_file(path, mimetype='application/gzip', download_name=download_name, etag=False,
+                             conditional=True)
+
+    db = get_db()[branch]
+    return app.response_class(stream_with_context(export.iter_export_gzip(db, repo, arch)),
+                              mimetype='application/gzip',
+                              headers={'Content-Disposition': f'attachment; filename="{download_name}"'})
+
+
+# content codings of the precompressed apkindex files, by preference
+APKINDEX_ENCODINGS = [("zstd", ".zst"), ("gzip", ".gz")]
+
+
 @app.route('/apkindex/<branch>/<path:repo>/<arch>')
 def apkindex(branch, repo, arch):
     db = get_db()
@@ -560,31 +1340,90 @@ def apkindex(branch, repo, arch):
 
     icache = get_apkindex_cache() / f"apkindex_{repo.replace('/', '_')}_{arch}.txt"
 
-    if not icache.is_file():
+    # serve a precompressed variant from the updater when it is accepted
+    path, encoding = icache, None
+    for enc, suffix in APKINDEX_ENCODINGS:
+        variant = icache.with_name(icache.name + suffix)
+        if request.accept_encodings[enc] > 0 and variant.is_file():
+            path, encoding = variant, enc
+            break
+
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return abort(404)
+
+    # the updater only replaces the files when they change, so this is
+    # as good as a content hash; each variant gets its own tag
+    st = os.fstat(f.fileno())
+    resp = send_file(
+        f,
+        mimetype="text/plain",
+        etag=f"{st.st_mtime_ns:x}-{st.st_size:x}",
+        last_modified=st.st_mtime,
+        conditional=True,
+    )
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+METRICS = {
+    'request': ('apkbrowser_request_duration_seconds', 'route', 'Time to handle a request, up to the start of the body.'),
+    'query': ('apkbrowser_query_duration_seconds', 'query', 'Time taken by database queries, by the function running them.'),
+    'render': ('apkbrowser_render_duration_seconds', 'template', 'Time taken to render templates.'),
+}
+
+
+def prometheus_labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.enabled():
         return abort(404)
 
-    return send_file(icache, mimetype="text/plain")
+    lines = []
+    histograms = metrics.histograms()
+    bounds = [str(b) for b in Metrics.BUCKETS] + ['+Inf']
+    for kind, (metric, label, text) in METRICS.items():
+        lines.append(f"# HELP {metric} {text}")
+        lines.append(f"# TYPE {metric} histogram")
+        for name, (counts, total) in sorted(histograms.get(kind, {}).items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                lines.append(f"{metric}_bucket{prometheus_labels(**{label: name, 'le': bound})} {cumulative}")
+            lines.append(f"{metric}_sum{prometheus_labels(**{label: name})} {total}")
+            lines.append(f"{metric}_count{prometheus_labels(**{label: name})} {cumulative}")
+
+    stats = response_cache.stats() if response_cache.enabled() else None
+    if stats is not None:
+        lines.append("# HELP apkbrowser_response_cache_events_total Lookups and evictions of the response cache.")
+        lines.append("# TYPE apkbrowser_response_cache_events_total counter")
+        for event in ['hits', 'misses', 'errors', 'evictions']:
+            lines.append(f"apkbrowser_response_cache_events_total{prometheus_labels(event=event)} {stats.get(event, 0)}")
+        lines.append("# HELP apkbrowser_response_cache_entries Pages in the response cache.")
+        lines.append("# TYPE apkbrowser_response_cache_entries gauge")
+        lines.append(f"apkbrowser_response_cache_entries {stats['entries']}")
+        lines.append("# HELP apkbrowser_response_cache_bytes Size of the pages in the response cache.")
+        lines.append("# TYPE apkbrowser_response_cache_bytes gauge")
+        lines.append(f"apkbrowser_response_cache_bytes {stats['size']}")
+
+    return app.response_class("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
 
 
 def do_exit():
     print("running exit commands and exiting...")
 
-    # and a second time, just to run it only once..
-    try:
-        # this is only available inside uwsgi context
-        import uwsgi
-
-        # they start from 1
-        do_once = uwsgi.worker_id() == 1
-    except ImportError:
-        do_once = True
-
-    if do_once:
-        with app.app_context():
-            db = get_db()
-            for branch in get_branches():
-                cur = db[branch].cursor()
-                cur.execute("PRAGMA optimize")
+    db_pool.close()
+    response_cache.close()
+    metrics.close()
 
 
 try:
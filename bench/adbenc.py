@@ -0,0 +1,149 @@
+import zlib
+import struct
+
+import common  # noqa: F401, puts the repository on the path
+import adb
+
+# the inverse of adb.py: encodes dicts shaped like what adb.decode()
+# returns, driven by the same schemas, so that the benchmarks can write
+# indexes and packages the updater reads like real ones
+
+HSIZE_UNITS = {"B": 1, "KiB": 1024, "MiB": 1024**2, "GiB": 1024**3}
+
+# longest first, so that "<=" is not taken for "<"
+DEPENDENCY_OPS = sorted(
+    ((op, mask) for mask, op in adb.VERSION_OPS.items() if op),
+    key=lambda x: -len(x[0]),
+)
+
+
+class AdbWriter:
+    def __init__(self):
+        # room for the header of the database block
+        self.buf = bytearray(8)
+
+    def _align(self, n):
+        self.buf += bytes(-len(self.buf) % n)
+
+    def blob(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        if len(data) < 256:
+            offs = len(self.buf)
+            self.buf += bytes([len(data)]) + data
+            return adb.TYPE_BLOB_8 | offs
+        if len(data) < 65536:
+            self._align(2)
+            offs = len(self.buf)
+            self.buf += struct.pack("<H", len(data)) + data
+            return adb.TYPE_BLOB_16 | offs
+        self._align(4)
+        offs = len(self.buf)
+        self.buf += struct.pack("<I", len(data)) + data
+        return adb.TYPE_BLOB_32 | offs
+
+    def integer(self, value):
+        if value <= adb.VALUE_MASK:
+            return adb.TYPE_INT | value
+        self._align(8)
+        offs = len(self.buf)
+        self.buf += struct.pack("<Q", value)
+        return adb.TYPE_INT_64 | offs
+
+    def slots(self, vals, vtype):
+        # objects do not store trailing empty fields
+        if vtype == adb.TYPE_OBJECT:
+            while vals and vals[-1] == adb.VAL_NULL:
+                vals = vals[:-1]
+        self._align(4)
+        offs = len(self.buf)
+        self.buf += struct.pack(f"<{len(vals) + 1}I", len(vals) + 1, *vals)
+        return vtype | offs
+
+    def finish(self, root, schema, data=b""):
+        self.buf[0:8] = struct.pack("<BBHI", 0, 1, 0, root)
+        blk = struct.pack("<I", 4 + len(self.buf)) + bytes(self.buf)
+        blk = blk.ljust(adb.align(len(blk)), b"\0")
+        return adb.ADB_MAGIC + schema + blk + data
+
+
+def dependency(wr, dep):
+    mask = 0
+    if dep.startswith("!"):
+        mask |= adb.VERSION_CONFLICT
+        dep = dep[1:]
+    for op, opmask in DEPENDENCY_OPS:
+        name, sep, ver = dep.partition(op)
+        if sep:
+            vals = [wr.blob(name), wr.blob(ver), wr.integer(mask | opmask)]
+            return wr.slots(vals, adb.TYPE_OBJECT)
+    vals = [wr.blob(dep), adb.VAL_NULL, wr.integer(mask) if mask else adb.VAL_NULL]
+    return wr.slots(vals, adb.TYPE_OBJECT)
+
+
+def hsize(value):
+    if isinstance(value, int):
+        return value
+    size, unit = value.split(" ")
+    return int(size) * HSIZE_UNITS[unit]
+
+
+SCALARS = {
+    adb.scalar_string: lambda wr, v: wr.blob(v),
+    adb.scalar_hexblob: lambda wr, v: wr.blob(bytes.fromhex(v)),
+    adb.scalar_int: lambda wr, v: wr.integer(int(v)),
+    adb.scalar_oct: lambda wr, v: wr.integer(int(v, 8)),
+    adb.scalar_hsize: lambda wr, v: wr.integer(hsize(v)),
+    adb.scalar_dependency: dependency,
+}
+
+
+def encode_value(wr, value, kind):
+    if isinstance(kind, dict):
+        return encode_object(wr, value, kind)
+    if isinstance(kind, list):
+        items = [encode_value(wr, v, kind[0]) for v in value]
+        return wr.slots(items, adb.TYPE_ARRAY)
+    return SCALARS[kind](wr, value)
+
+
+def encode_object(wr, value, schema):
+    vals = [adb.VAL_NULL] * max(schema)
+    for fid, (name, kind) in schema.items():
+        if value.get(name, None) is not None:
+            vals[fid - 1] = encode_value(wr, value[name], kind)
+    return wr.slots(vals, adb.TYPE_OBJECT)
+
+
+def encode(value, schema, data=b"", compress=True):
+    # data is appended as a data block, like the file contents of a
+    # package, to give it a realistic size
+    wr = AdbWriter()
+    root = encode_object(wr, value, adb.SCHEMAS[schema])
+    blocks = b""
+    if data:
+        blocks = struct.pack("<I", (adb.BLOCK_DATA << 30) | (4 + len(data))) + data
+        blocks = blocks.ljust(adb.align(len(blocks)), b"\0")
+    raw = wr.finish(root, schema, blocks)
+    if not compress:
+        return raw
+    comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return b"ADBd" + comp.compress(raw) + comp.flush()
+
+
+def encode_index(packages, description="benchmark index"):
+    return encode({"description": description, "packages": packages}, b"indx")
+
+
+def encode_package(info, files, data=b""):
+    dirs = {}
+    for path in files:
+        dname, fname = path.lstrip("/").rpartition("/")[0::2]
+        dirs.setdefault(dname, []).append(
+            {"name": fname, "acl": {"mode": "644"}, "size": 0, "hash": "00" * 32}
+        )
+    paths = [
+        {"name": dname or None, "acl": {"mode": "755"}, "files": dfiles}
+        for dname, dfiles in dirs.items()
+    ]
+    return encode({"info": info, "paths": paths}, b"pckg", data)
@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import platform
+import statistics
+import subprocess
+import importlib.util
+
+# shared bits of the benchmarks: loading the two programs with a config
+# of our own, and summarizing, storing and comparing timings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+
+def bench_config(workdir, branch="bench", arches=None, repos=None):
+    arches = arches or ["x86_64"]
+    repos = repos or ["main"]
+    return {
+        "branding": {"name": "bench", "logo": "logo.svg", "favicon": "favicon"},
+        "repository": {
+            "url": f"file://{workdir}/repo",
+            "branches": branch,
+            "arches": ",".join(arches),
+            "repos": ",".join(repos),
+            "default-branch": branch,
+            "default-arch": arches[0],
+        },
+        "external": {
+            "git-commit": "https://example.org/commit/{commit}",
+            "git-repo": "https://example.org/repo",
+            "build-log": "https://example.org/build",
+            "website": "https://example.org",
+        },
+        "database": {"path": os.path.join(workdir, "db")},
+        "settings": {
+            "branch": "yes",
+            "flagging": "no",
+            "apkindex-cache": os.path.join(workdir, "apkindex_cache"),
+        },
+    }
+
+
+def load_updater(config):
+    # the file name has a dash in it, so it cannot simply be imported
+    spec = importlib.util.spec_from_file_location(
+        "update_database", os.path.join(ROOT, "update-database.py")
+    )
+    upd = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(upd)
+    upd.config.clear()
+    upd.config.read_dict(config)
+    return upd
+
+
+def load_app(config):
+    import app
+
+    app.config.clear()
+    app.config.read_dict(config)
+    return app
+
+
+def timed(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def summarize(times):
+    # seconds in, milliseconds out
+    ms = sorted(t * 1000 for t in times)
+    if len(ms) > 1:
+        q = statistics.quantiles(ms, n=100, method="inclusive")
+        p50, p95, p99 = q[49], q[94], q[98]
+    else:
+        p50 = p95 = p99 = ms[0]
+    return {
+        "n": len(ms),
+        "min": ms[0],
+        "mean": statistics.fmean(ms),
+        "p50": p50,
+        "p95": p95,
+        "p99": p99,
+        "max": ms[-1],
+    }
+
+
+def get_meta(params):
+    try:
+        commit = subprocess.run(
+            ["git", "-C", ROOT, "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    import sqlite3
+
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+        "time": int(time.time()),
+        "params": params,
+    }
+
+
+def print_results(results, baseline=None):
+    width = max([len(name) for name in results] + [4])
+    header = f"{'case':<{width}} {'n':>5} {'p50':>9} {'p95':>9} {'p99':>9}"
+    if baseline:
+        header += f" {'p50 vs base':>12}"
+    print(header)
+    for name, res in results.items():
+        line = (
+            f"{name:<{width}} {res['n']:>5} {res['p50']:>9.3f} "
+            f"{res['p95']:>9.3f} {res['p99']:>9.3f}"
+        )
+        base = (baseline or {}).get(name, None)
+        if base and base["p50"] > 0:
+            line += f" {res['p50'] / base['p50']:>11.2f}x"
+        print(line)
+    print("(milliseconds)")
+
+
+def load_baseline(path):
+    if not path:
+        return None
+    with open(path) as inf:
+        return json.load(inf)["results"]
+
+
+def write_results(path, meta, results):
+    if not path:
+        return
+    with open(path, "w") as outf:
+        json.dump({"meta": meta, "results": results}, outf, indent=2)
+        outf.write("\n")
@@ -0,0 +1,282 @@
+import os
+import sys
+import time
+import random
+import shutil
+import pathlib
+import argparse
+import functools
+import threading
+import contextlib
+import http.server
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import common
+import adbenc
+import synthetic
+
+# runs the updater end to end against a generated repository, served over
+# http by a local server and read straight from disk through file://, for
+# a cold import, an incremental update and an update where nothing changed
+
+BRANCH = "bench"
+REPO = "main"
+
+
+def mutate(rng, packages, changes, nfiles, fanout, nmaintainers):
+    # a new revision of some packages, a few removed and a few added
+    count = max(len(packages) * changes // 100, 2)
+    updated = list(packages)
+    for i in rng.sample(range(len(updated)), count):
+        package, files = updated[i]
+        ver, rev = package["version"].rsplit("-r", 1)
+        package = dict(package, version=f"{ver}-r{int(rev) + 1}")
+        package["build-time"] += 86400
+        updated[i] = (package, files)
+    removed = set(rng.sample(range(len(updated)), count // 2))
+    updated = [p for i, p in enumerate(updated) if i not in removed]
+    for package, files in synthetic.make_packages(rng, count // 2, nfiles, fanout, nmaintainers):
+        package["name"] = f"new{package['name']}"
+        package["origin"] = f"new{package['origin']}"
+        updated.append((package, files))
+    return updated
+
+
+def write_packages(repod, arch, packages, apk_size, rng):
+    archd = repod / BRANCH / REPO / arch
+    archd.mkdir(parents=True, exist_ok=True)
+    nbytes = 0
+    for package, files in packages:
+        path = archd / f"{package['name']}-{package['version']}.apk"
+        if path.exists():
+            continue
+        # incompressible, as package contents mostly are
+        data = rng.randbytes(int(rng.expovariate(1 / apk_size))) if apk_size else b""
+        content = adbenc.encode_package(dict(package, arch=arch), files, data)
+        path.write_bytes(content)
+        nbytes += len(content)
+    return nbytes
+
+
+def write_index(repod, arch, packages, mtime):
+    path = repod / BRANCH / REPO / arch / "APKINDEX.tar.gz"
+    path.write_bytes(adbenc.encode_index([dict(p, arch=arch) for p, files in packages]))
+    # the server answers If-Modified-Since with a resolution of seconds,
+    # so every index gets a time of its own
+    os.utime(path, (mtime, mtime))
+
+
+class CountingHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes
+    disable_nagle_algorithm = True
+    sent = 0
+    lock = threading.Lock()
+
+    def copyfile(self, source, outputfile):
+        # the updater hangs up once it has the head of a package
+        try:
+            for chunk in iter(lambda: source.read(65536), b""):
+                outputfile.write(chunk)
+                with self.lock:
+                    CountingHandler.sent += len(chunk)
+        except ConnectionError:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(repod):
+    handler = functools.partial(CountingHandler, directory=str(repod))
+    server = QuietServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class CountingFile:
+    def __init__(self, f, counts, lock):
+        self.f = f
+        self.counts = counts
+        self.lock = lock
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        with self.lock:
+            self.counts["bytes"] += len(data)
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+def peak_rss():
+    # in KiB; unlike ru_maxrss, which a spawned child inherits from the
+    # process it was started from, this starts over at exec
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+    return 0
+
+
+def run_scenario(config, verbose=False):
+    # runs in a process of its own, for a peak rss of just this run
+    upd = common.load_updater(config)
+    counts = {"packages": 0, "files": 0, "bytes": 0, "subprocesses": 0}
+    lock = threading.Lock()
+
+    def audit(event, args):
+        if event == "subprocess.Popen":
+            counts["subprocesses"] += 1
+
+    sys.addaudithook(audit)
+
+    # reads of file:// urls, http is counted by the server
+    def counting_open(*args, **kwargs):
+        f = open(*args, **kwargs)
+        if "b" in kwargs.get("mode", args[1] if len(args) > 1 else "r"):
+            return CountingFile(f, counts, lock)
+        return f
+
+    upd.open = counting_open
+
+    add_packages = upd.add_packages
+    get_file_list = upd.get_file_list
+
+    def counting_add_packages(*args):
+        pids = add_packages(*args)
+        counts["packages"] += len(pids)
+        return pids
+
+    def counting_get_file_list(url):
+        files = get_file_list(url)
+        with lock:
+            counts["files"] += len(files)
+        return files
+
+    upd.add_packages = counting_add_packages
+    upd.get_file_list = counting_get_file_list
+
+    out = sys.stdout if verbose else open(os.devnull, "w")
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        upd.generate(BRANCH, None, int(config["settings"]["fetch-jobs"]))
+    counts["wall"] = time.perf_counter() - start
+    counts["peak_rss"] = peak_rss()
+    return counts
+
+
+def reset_database(config):
+    dbp = config["database"]["path"]
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        pathlib.Path(dbp, f"cports-{BRANCH}.db{suffix}").unlink(missing_ok=True)
+    shutil.rmtree(config["settings"]["apkindex-cache"], ignore_errors=True)
+
+
+def run(args):
+    workdir = pathlib.Path(args.workdir).absolute()
+    arches = args.arches.split(",")
+    repod = workdir / "repo"
+    shutil.rmtree(repod, ignore_errors=True)
+    (workdir / "db").mkdir(parents=True, exist_ok=True)
+
+    rng = random.Random(args.seed)
+    packages = synthetic.make_packages(rng, args.packages, args.files, args.fanout, args.maintainers)
+    updated = mutate(rng, packages, args.changes, args.files, args.fanout, args.maintainers)
+
+    start = time.monotonic()
+    nbytes = 0
+    for arch in arches:
+        nbytes += write_packages(repod, arch, packages + updated, args.apk_size, rng)
+    print(f"generated {len(packages)} packages per arch, {nbytes >> 20} MiB in {time.monotonic() - start:.1f}s")
+
+    server = start_server(repod)
+    spawn = multiprocessing.get_context("spawn")
+    results = {}
+    try:
+        for transport in args.transports.split(","):
+            config = common.bench_config(str(workdir), BRANCH, arches, [REPO])
+            config["settings"]["fetch-jobs"] = str(args.fetch_jobs)
+            if transport == "http":
+                config["repository"]["url"] = f"http://127.0.0.1:{server.server_port}"
+            reset_database(config)
+
+            mtime = int(time.time()) - 3600
+            for scenario, index in [("cold", packages), ("incremental", updated), ("noop", None)]:
+                if index is not None:
+                    mtime += 60
+                    for arch in arches:
+                        write_index(repod, arch, index, mtime)
+                CountingHandler.sent = 0
+                with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                    res = pool.submit(run_scenario, config, args.verbose).result()
+                res["bytes"] += CountingHandler.sent
+                results[f"{transport} {scenario}"] = {
+                    "wall": res["wall"],
+                    "packages": res["packages"],
+                    "packages_per_s": res["packages"] / res["wall"],
+                    "files": res["files"],
+                    "files_per_s": res["files"] / res["wall"],
+                    "bytes": res["bytes"],
+                    "subprocesses": res["subprocesses"],
+                    "peak_rss_kib": res["peak_rss"],
+                }
+    finally:
+        server.shutdown()
+    return results
+
+
+def print_results(results, baseline=None):
+    width = max(len(name) for name in results)
+    header = (
+        f"{'scenario':<{width}} {'wall s':>8} {'pkgs':>7} {'pkgs/s':>8} "
+        f"{'files/s':>9} {'MiB':>8} {'procs':>6} {'rss MiB':>8}"
+    )
+    if baseline:
+        header += f" {'wall vs base':>13}"
+    print(header)
+    for name, res in results.items():
+        line = (
+            f"{name:<{width}} {res['wall']:>8.2f} {res['packages']:>7} "
+            f"{res['packages_per_s']:>8.0f} {res['files_per_s']:>9.0f} "
+            f"{res['bytes'] / 2**20:>8.1f} {res['subprocesses']:>6} "
+            f"{res['peak_rss_kib'] / 1024:>8.0f}"
+        )
+        base = (baseline or {}).get(name, None)
+        if base and base["wall"] > 0:
+            line += f" {res['wall'] / base['wall']:>12.2f}x"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the updater against a generated repository.")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--apk-size", type=int, default=16384, help="mean size of the package contents in bytes")
+    parser.add_argument("--changes", type=int, default=2, help="percentage of packages changed by the incremental update")
+    parser.add_argument("--transports", default="http,file", help="comma separated, http and/or file")
+    parser.add_argument("--fetch-jobs", type=int, default=4)
+    parser.add_argument("--verbose", action="store_true", help="show the output of the updater")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare against results from an earlier run")
+    args = parser.parse_args()
+
+    results = run(args)
+    print_results(results, common.load_baseline(args.baseline))
+    common.write_results(args.output, common.get_meta(vars(args)), results)
+    sys.exit(0)
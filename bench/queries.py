@@ -0,0 +1,114 @@
+import os
+import sys
+import argparse
+
+import common
+import synthetic
+
+# times the query functions of app.py and its routes against a synthetic
+# database; results can be written as json and compared to an earlier run
+
+
+def query_cases(app, branch, sample):
+    # (name, callable) pairs, run inside a request context
+    name, origin = sample["name"], sample["origin"]
+    word = name[:3]
+    arch, repo = sample["arch"], sample["repo"]
+    cursor = app.get_packages_cursor(app.get_packages(branch, 0))
+    cursor = app.decode_cursor(cursor, app.PACKAGES_CURSOR) if cursor else None
+    return [
+        ("get_packages", lambda: app.get_packages(branch, 0)),
+        ("get_packages deep offset", lambda: app.get_packages(branch, 5000)),
+        ("get_packages cursor", lambda: app.get_packages(branch, 0, after=cursor)),
+        ("get_packages name", lambda: app.get_packages(branch, 0, name=f"{word}*")),
+        ("get_packages maintainer", lambda: app.get_packages(branch, 0, maintainer="Maintainer 7")),
+        ("get_num_packages", lambda: app.get_num_packages(branch)),
+        ("get_num_packages arch", lambda: app.get_num_packages(branch, arch=arch)),
+        ("get_num_packages name", lambda: app.get_num_packages(branch, name=f"{word}*")),
+        ("get_package", lambda: app.get_package(branch, repo, arch, name)),
+        ("get_package origin", lambda: app.get_package(branch, repo, arch, origin)),
+        ("get_contents file", lambda: app.get_contents(branch, 0, file="file1.h")),
+        ("get_contents file suffix", lambda: app.get_contents(branch, 0, file="*1.py")),
+        ("get_contents path", lambda: app.get_contents(branch, 0, path=f"/usr/include/{origin}")),
+        ("get_contents name", lambda: app.get_contents(branch, 0, name=name)),
+        ("get_num_contents file", lambda: app.get_num_contents(branch, file="file1.h")),
+        ("get_num_contents file suffix", lambda: app.get_num_contents(branch, file="*1.py")),
+    ]
+
+
+def route_cases(branch, sample):
+    name, arch, repo = sample["name"], sample["arch"], sample["repo"]
+    return [
+        ("GET /packages", "/packages"),
+        ("GET /packages page 100", "/packages?page=100"),
+        ("GET /packages name", f"/packages?name={name[:3]}*"),
+        ("GET /contents file", "/contents?file=file1.h"),
+        ("GET /contents file suffix", "/contents?file=*1.py"),
+        ("GET /package", f"/package/{branch}/{repo}/{arch}/{name}"),
+        ("GET /api/packages", "/api/packages"),
+        ("GET /api/package", f"/api/package/{branch}/{repo}/{arch}/{name}"),
+        ("GET /apkindex", f"/apkindex/{branch}/{repo}/{arch}"),
+    ]
+
+
+def run(config, repeat, only=None):
+    app = common.load_app(config)
+    branch = config["repository"]["default-branch"]
+
+    results = {}
+    with app.app.test_request_context():
+        # a package with dependencies and reverse dependencies
+        cur = app.get_db()[branch].cursor()
+        cur.execute("""
+            SELECT packages.name, packages.origin, packages.arch, packages.repo
+            FROM packages
+            JOIN reverse_depends ON reverse_depends.target_pid = packages.id
+            GROUP BY packages.id
+            ORDER BY count(*) DESC
+            LIMIT 1
+        """)
+        sample = dict(zip(["name", "origin", "arch", "repo"], cur.fetchone()))
+
+        for name, fn in query_cases(app, branch, sample):
+            if only and only not in name:
+                continue
+            results[name] = common.summarize(common.timed(fn, repeat))
+
+    client = app.app.test_client()
+    for name, url in route_cases(branch, sample):
+        if only and only not in name:
+            continue
+
+        def get():
+            resp = client.get(url)
+            if resp.status_code != 200:
+                raise RuntimeError(f"{url} returned {resp.status_code}")
+            resp.get_data()
+
+        results[name] = common.summarize(common.timed(get, repeat))
+
+    app.db_pool.close()
+    return results, sample
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the queries and routes of the web frontend.")
+    synthetic.add_arguments(parser)
+    parser.add_argument("--reuse", action="store_true", help="use the database already in the workdir")
+    parser.add_argument("--repeat", type=int, default=50, help="timed runs per case")
+    parser.add_argument("--only", help="only run cases containing this")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--baseline", help="compare against results from an earlier run")
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir)
+    if args.reuse and os.path.exists(os.path.join(workdir, "db", "cports-bench.db")):
+        config = common.bench_config(workdir, arches=args.arches.split(","))
+    else:
+        config = synthetic.generate_from_args(args)
+
+    results, sample = run(config, args.repeat, args.only)
+    common.print_results(results, common.load_baseline(args.baseline))
+    params = dict(vars(args), sample=sample)
+    common.write_results(args.output, common.get_meta(params), results)
+    sys.exit(0)
@@ -0,0 +1,171 @@
+import os
+import sys
+import time
+import random
+import argparse
+import contextlib
+
+import common
+
+# generates a branch database of a chosen scale through the code of the
+# updater itself, with packages in groups of a main package and its
+# -libs and -devel subpackages, so:/cmd: provides and dependencies on
+# earlier packages
+
+WORDS = [
+    "core", "util", "net", "gtk", "qt", "py", "perl", "font", "x", "media",
+    "sound", "image", "crypto", "db", "text", "shell", "kde", "gnome", "rs",
+]
+
+
+def make_files(rng, name, kind, nfiles):
+    if kind == "-libs":
+        files = [f"/usr/lib/lib{name}.so.{rng.randrange(1, 9)}"]
+        prefix = f"/usr/lib/{name}"
+    elif kind == "-devel":
+        files = [f"/usr/lib/lib{name}.so", f"/usr/lib/pkgconfig/{name}.pc"]
+        prefix = f"/usr/include/{name}"
+    else:
+        files = [f"/usr/bin/{name}", f"/usr/share/man/man1/{name}.1"]
+        prefix = f"/usr/share/{name}"
+    # a few subdirectories, like real data files tend to have
+    subdirs = [""] + [f"/{rng.choice(WORDS)}{k}" for k in range(rng.randrange(1, 6))]
+    for k in range(max(nfiles - len(files), 0)):
+        files.append(f"{prefix}{rng.choice(subdirs)}/file{k}.{rng.choice(['h', 'dat', 'py', 'txt'])}")
+    return files
+
+
+def make_packages(rng, npackages, nfiles, fanout, nmaintainers):
+    # (package without arch, file list), in build order
+    maintainers = [f"Maintainer {i} <m{i}@example.org>" for i in range(nmaintainers)]
+    names = []
+    libs = []
+    packages = []
+    for i in range(npackages):
+        base = f"{WORDS[(i // 3) % len(WORDS)]}{i // 3}"
+        kind = ["", "-libs", "-devel"][i % 3]
+        name = base + kind
+        version = f"{rng.randrange(1, 20)}.{rng.randrange(50)}.{rng.randrange(10)}-r{rng.randrange(5)}"
+
+        provides = []
+        depends = []
+        if kind == "-libs":
+            provides.append(f"so:lib{base}.so.1=1")
+            libs.append(f"so:lib{base}.so.1")
+        elif kind == "-devel":
+            provides.append(f"pc:{base}={version.split('-')[0]}")
+            depends.append(f"{base}-libs={version}")
+        else:
+            provides.append(f"cmd:{base}={version}")
+        # dependencies on earlier packages, mostly on libraries
+        for _ in range(min(rng.randrange(fanout * 2 + 1), len(names))):
+            if libs and rng.random() < 0.7:
+                depends.append(rng.choice(libs))
+            else:
+                depends.append(rng.choice(names))
+        # a package could have picked itself up through its libs
+        depends = [d for d in dict.fromkeys(depends) if d != name]
+
+        count = max(1, int(rng.expovariate(1 / nfiles)))
+        packages.append(
+            (
+                {
+                    "name": name,
+                    "version": version,
+                    "description": f"synthetic package {name}",
+                    "url": f"https://example.org/{base}",
+                    "license": rng.choice(["MIT", "BSD-2-Clause", "GPL-2.0-or-later"]),
+                    "origin": base,
+                    "maintainer": rng.choice(maintainers),
+                    "build-time": 1700000000 + i * 60,
+                    "file-size": f"{rng.randrange(1, 900)} KiB",
+                    "installed-size": f"{rng.randrange(1, 900)} KiB",
+                    "unique-id": f"{rng.getrandbits(160):040x}",
+                    "repo-commit": f"{rng.getrandbits(160):040x}",
+                    "provides": provides,
+                    "depends": depends,
+                },
+                make_files(rng, base, kind, count),
+            )
+        )
+        names.append(name)
+    return packages
+
+
+def generate(workdir, npackages, arches, nfiles, fanout, nmaintainers, seed):
+    config = common.bench_config(workdir, arches=arches)
+    upd = common.load_updater(config)
+    os.makedirs(os.path.join(workdir, "db"), exist_ok=True)
+    dbpath = os.path.join(workdir, "db", "cports-bench.db")
+    upd.remove_database(dbpath)
+
+    rng = random.Random(seed)
+    packages = make_packages(rng, npackages, nfiles, fanout, nmaintainers)
+
+    # the file lists come from the generated data instead of the network
+    file_lists = {}
+    url = config["repository"]["url"]
+    for arch in arches:
+        for package, files in packages:
+            file_lists[f"{url}/bench/main/{arch}/{package['name']}-{package['version']}.apk"] = files
+    upd.get_file_list = file_lists.__getitem__
+
+    db = upd.connect(dbpath)
+    upd.set_options(db)
+    cur = db.cursor()
+    cur.execute("BEGIN")
+    upd.create_tables(db)
+    upd.drop_bulk_indexes(db)
+    maintainers = upd.load_maintainers(db)
+
+    start = time.monotonic()
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        for arch in arches:
+            pkgs = (dict(package, arch=arch) for package, files in packages)
+            upd.add_packages(db, maintainers, "bench", "main", arch, pkgs)
+        upd.rebuild_bulk_indexes(db)
+        upd.ensure_resolved_depends(db)
+        upd.update_package_counts(db)
+        for arch in arches:
+            upd.update_v2index(db, "main", arch)
+        upd.bump_generation(db)
+    cur.execute("COMMIT")
+    cur.execute("ANALYZE")
+    db.close()
+
+    cur = upd.connect(dbpath).cursor()
+    counts = {}
+    for table in ["packages", "files", "dirs", "filelists", "depends", "provides"]:
+        cur.execute(f"SELECT count(*) FROM {table}")
+        counts[table] = cur.fetchone()[0]
+    print(f"generated {dbpath} in {time.monotonic() - start:.1f}s: {counts}")
+    return config
+
+
+def add_arguments(parser):
+    parser.add_argument("--workdir", default="bench-data", help="where to put the database")
+    parser.add_argument("--packages", type=int, default=2000, help="packages per arch")
+    parser.add_argument("--arches", default="x86_64,aarch64", help="comma separated arches")
+    parser.add_argument("--files", type=int, default=40, help="mean files per package")
+    parser.add_argument("--fanout", type=int, default=4, help="mean dependencies per package")
+    parser.add_argument("--maintainers", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def generate_from_args(args):
+    return generate(
+        os.path.abspath(args.workdir),
+        args.packages,
+        args.arches.split(","),
+        args.files,
+        args.fanout,
+        args.maintainers,
+        args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic branch database.")
+    add_arguments(parser)
+    generate_from_args(parser.parse_args())
+    sys.exit(0)
@@ -0,0 +1,130 @@
+import os
+import json
+import posixpath
+import zlib
+import pathlib
+import tempfile
+
+# every package of a repo/arch with its relations and files, as gzipped
+# newline separated json; used by the export route of the web frontend
+# and precomputed per database generation by the updater
+
+PACKAGE_FIELDS = [
+    "name",
+    "version",
+    "description",
+    "url",
+    "license",
+    "arch",
+    "repo",
+    "origin",
+    "commit",
+    "size",
+    "installed_size",
+    "provider_priority",
+    "build_time",
+]
+
+
+class Relation:
+    # rows of a query ordered by package id, consumed alongside the
+    # packages so that nothing is held beyond the current package
+    def __init__(self, db, sql, args):
+        self.cur = db.cursor()
+        self.cur.execute(sql, args)
+        self.row = self.cur.fetchone()
+
+    def take(self, pid):
+        rows = []
+        while self.row is not None and self.row[0] <= pid:
+            if self.row[0] == pid:
+                rows.append(self.row[1:])
+            self.row = self.cur.fetchone()
+        return rows
+
+
+def iter_export(db, repo, arch):
+    # yields one dict per package, in id order
+    args = [repo, arch]
+    fields = ", ".join(f'packages."{field}"' for field in PACKAGE_FIELDS)
+
+    relations = {}
+    for table in ["depends", "provides", "install_if"]:
+        sql = f"""
+            SELECT {table}.pid, {table}.name, {table}.operator, {table}.version
+            FROM {table}
+            JOIN packages ON packages.id = {table}.pid
+            WHERE packages.repo = ? AND packages.arch = ?
+            ORDER BY {table}.pid, {table}.rowid
+        """
+        relations[table] = Relation(db, sql, args)
+
+    sql = """
+        SELECT packages.id, dirs.path, files.file
+        FROM packages
+        JOIN files ON files.fid = packages.fid
+        JOIN dirs ON dirs.id = files.did
+        WHERE packages.repo = ? AND packages.arch = ?
+        ORDER BY packages.id, dirs.path, files.file
+    """
+    files = Relation(db, sql, args)
+
+    sql = f"""
+        SELECT packages.id, {fields}, maintainer.name, maintainer.email
+        FROM packages
+        LEFT JOIN maintainer ON maintainer.id = packages.maintainer
+        WHERE packages.repo = ? AND packages.arch = ?
+        ORDER BY packages.id
+    """
+    cur = db.cursor()
+    cur.execute(sql, args)
+    for pid, *row in cur:
+        package = dict(zip(PACKAGE_FIELDS, row))
+        mname, memail = row[len(PACKAGE_FIELDS) :]
+        package["maintainer"] = {"name": mname, "email": memail} if memail else None
+        for table, relation in relations.items():
+            package[table] = [
+                {"name": name, "operator": op, "version": ver}
+                for name, op, ver in relation.take(pid)
+            ]
+        package["files"] = [posixpath.join(path, file) for path, file in files.take(pid)]
+        yield package
+
+
+def iter_export_gzip(db, repo, arch, level=6):
+    # the export as chunks of a gzip stream, for sending as it is made
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    buf = []
+    size = 0
+    for package in iter_export(db, repo, arch):
+        line = json.dumps(package).encode() + b"\n"
+        buf.append(line)
+        size += len(line)
+        if size >= 65536:
+            chunk = comp.compress(b"".join(buf))
+            buf.clear()
+            size = 0
+            if chunk:
+                yield chunk
+    yield comp.compress(b"".join(buf)) + comp.flush()
+
+
+def get_export_path(exportd, branch, repo, arch, generation):
+    name = f"{repo.replace('/', '_')}_{arch}.{generation}.ndjson.gz"
+    return pathlib.Path(exportd) / branch / name
+
+
+def write_export(db, path, repo, arch):
+    # written next to the target and renamed, so readers never see a
+    # partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as outf:
+            for chunk in iter_export_gzip(db, repo, arch):
+                outf.write(chunk)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
@@ -0,0 +1,140 @@
+import os
+import sys
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "..", "bench"))
+
+from adbenc import AdbWriter  # noqa: E402
+
+# writes the fixtures next to this file; the field ids and match flags
+# are spelled out as in apk-tools' src/apk_adb.h rather than taken from
+# the schemas of adb.py, and the .adbdump files were written by hand in
+# the format apk adbdump prints, so that neither side is derived from the
+# decoder under test. real files can be added as NAME plus NAME.adbdump
+# from `apk adbdump NAME`
+
+OBJECT = 0xE0000000
+ARRAY = 0xD0000000
+
+# match flags of dependencies
+EQUAL, LESS, GREATER, FUZZY, CONFLICT = 1, 2, 4, 8, 16
+
+
+def obj(wr, fields):
+    # fields is {field id: value}
+    vals = [0] * max(fields)
+    for fid, val in fields.items():
+        vals[fid - 1] = val
+    return wr.slots(vals, OBJECT)
+
+
+def dep(wr, name, version=None, match=None):
+    fields = {1: wr.blob(name)}
+    if version is not None:
+        fields[2] = wr.blob(version)
+    if match is not None:
+        fields[3] = wr.integer(match)
+    return obj(wr, fields)
+
+
+def pkginfo(wr, name, version, extra):
+    fields = {
+        1: wr.blob(name),
+        2: wr.blob(version),
+        3: wr.blob(bytes.fromhex("0123456789abcdef0123456789abcdef01234567")),
+        4: wr.blob(f"the {name} package"),
+        5: wr.blob("x86_64"),
+        6: wr.blob("BSD-2-Clause"),
+        7: wr.blob("fixture"),
+        8: wr.blob("Jane Doe <jane@example.org>"),
+        9: wr.blob("https://example.org/fixture"),
+        10: wr.blob(bytes.fromhex("fedcba9876543210fedcba9876543210fedcba98")),
+        11: wr.integer(1700000000),
+    }
+    fields.update(extra(wr))
+    return obj(wr, fields)
+
+
+def finish(wr, root, schema, compress):
+    raw = wr.finish(root, schema)
+    if not compress:
+        return raw
+    comp = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return b"ADBd" + comp.compress(raw) + comp.flush()
+
+
+def fixture_index():
+    wr = AdbWriter()
+    fixture = pkginfo(
+        wr,
+        "fixture",
+        "1.2.3_rc1-r2",
+        lambda wr: {
+            12: wr.integer(123456),
+            13: wr.integer(4096),
+            15: wr.slots(
+                [
+                    dep(wr, "so:libc.so.1"),
+                    dep(wr, "libfoo", "2.0", GREATER | EQUAL),
+                    dep(wr, "bar", "3", LESS),
+                    dep(wr, "baz", "1.2", FUZZY | EQUAL),
+                    dep(wr, "qux", "abc", LESS | GREATER),
+                    dep(wr, "old-fixture", None, CONFLICT),
+                    dep(wr, "older", "1.0", CONFLICT | LESS),
+                ],
+                ARRAY,
+            ),
+            16: wr.slots(
+                [dep(wr, "cmd:fixture", "1.2.3_rc1-r2", EQUAL), dep(wr, "fixture-any")],
+                ARRAY,
+            ),
+        },
+    )
+    devel = pkginfo(
+        wr,
+        "fixture-devel",
+        "1.2.3_rc1-r2",
+        lambda wr: {
+            12: wr.integer(20 * 1024 * 1024),
+            13: wr.integer(9999),
+            14: wr.integer(10),
+            18: wr.slots([dep(wr, "fixture", "1.2.3_rc1-r2", EQUAL), dep(wr, "devel-base")], ARRAY),
+        },
+    )
+    root = obj(wr, {1: wr.blob("fixture index"), 2: wr.slots([fixture, devel], ARRAY)})
+    return finish(wr, root, b"indx", compress=True)
+
+
+def fixture_package():
+    wr = AdbWriter()
+    info = pkginfo(wr, "fixture", "1.2.3_rc1-r2", lambda wr: {12: wr.integer(10000), 13: wr.integer(512)})
+
+    def file(name, size, mode=None):
+        fields = {1: wr.blob(name), 3: wr.integer(size), 4: wr.integer(1700000000)}
+        if mode is not None:
+            fields[2] = obj(wr, {1: wr.integer(mode)})
+        return obj(wr, fields)
+
+    paths = [
+        obj(wr, {2: obj(wr, {1: wr.integer(0o755)}), 3: wr.slots([file("toplevel", 1)], ARRAY)}),
+        obj(
+            wr,
+            {
+                1: wr.blob("usr/bin"),
+                2: obj(wr, {1: wr.integer(0o755), 2: wr.blob("root"), 3: wr.blob("root")}),
+                3: wr.slots([file("fixture", 2048, 0o755), file("fixture-helper", 0, 0o4755)], ARRAY),
+            },
+        ),
+        obj(wr, {1: wr.blob("usr/share/fixture"), 3: wr.slots([file("data file.txt", 77)], ARRAY)}),
+    ]
+    scripts = obj(wr, {3: wr.blob("#!/bin/sh\necho installed\nexit 0\n")})
+    root = obj(wr, {1: info, 2: wr.slots(paths, ARRAY), 3: scripts, 4: wr.slots([wr.blob("/usr/share/fixture/*")], ARRAY)})
+    return finish(wr, root, b"pckg", compress=False)
+
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, "APKINDEX.adb"), "wb") as outf:
+        outf.write(fixture_index())
+    with open(os.path.join(here, "fixture-1.2.3_rc1-r2.apk"), "wb") as outf:
+        outf.write(fixture_package())
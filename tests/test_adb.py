@@ -0,0 +1,107 @@
+import shutil
+import pathlib
+import subprocess
+import importlib.util
+
+import pytest
+
+import adb
+
+ROOT = pathlib.Path(__file__).parent.parent
+DATA = pathlib.Path(__file__).parent / "data" / "adb"
+
+# every NAME with a NAME.adbdump next to it, the output of apk adbdump
+FIXTURES = sorted(p.with_suffix("") for p in DATA.glob("*.adbdump"))
+
+
+def load_updater():
+    # the file name has a dash in it, so it cannot simply be imported
+    spec = importlib.util.spec_from_file_location("update_database", ROOT / "update-database.py")
+    upd = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(upd)
+    return upd
+
+
+upd = load_updater()
+
+
+def parse_dump(lines, rootn=None):
+    root = {}
+    for _ in upd.parse_adbdump(lines, rootn, root):
+        pass
+    return root
+
+
+def recorded(path, rootn=None):
+    with open(f"{path}.adbdump", "rb") as inf:
+        return parse_dump(inf, rootn)
+
+
+@pytest.fixture(params=FIXTURES, ids=lambda p: p.name)
+def fixture(request):
+    return request.param
+
+
+def test_decode(fixture):
+    assert adb.decode(fixture.read_bytes()) == recorded(fixture)
+
+
+def test_decode_root(fixture):
+    data = fixture.read_bytes()
+    full = recorded(fixture)
+    for key in full:
+        assert adb.decode(data, key) == {key: full[key]}
+        # the text parser leaves other sections empty rather than out
+        assert upd.dump_adb(data, f"{key}:".encode())[key] == recorded(fixture, f"{key}:".encode())[key]
+
+
+def test_iter_decode(fixture):
+    data = fixture.read_bytes()
+    for key, value in recorded(fixture).items():
+        if isinstance(value, list):
+            assert list(adb.iter_decode(data, key)) == value
+            assert list(upd.dump_adb(data, f"{key}:".encode(), incremental=True)) == value
+
+
+def test_head_reader(fixture):
+    # fed in small pieces, as the package metadata comes off the network
+    data = fixture.read_bytes()
+    reader = adb.AdbHeadReader()
+    for i in range(0, len(data), 7):
+        if reader.feed(data[i : i + 7]):
+            break
+    assert reader.result is not None
+    assert adb.decode(reader.result) == recorded(fixture)
+
+
+def test_index_details():
+    # the parts where a mistake in the text would not show up elsewhere
+    index = recorded(DATA / "APKINDEX.adb")
+    fixture, devel = index["packages"]
+    assert fixture["installed-size"] == "120 KiB"
+    assert fixture["depends"] == [
+        "so:libc.so.1",
+        "libfoo>=2.0",
+        "bar<3",
+        "baz~1.2",
+        "qux><abc",
+        "!old-fixture",
+        "!older<1.0",
+    ]
+    assert devel["provider-priority"] == "10"
+    assert devel["install-if"] == ["fixture=1.2.3_rc1-r2", "devel-base"]
+
+
+def test_truncated():
+    data = (DATA / "fixture-1.2.3_rc1-r2.apk").read_bytes()
+    with pytest.raises(adb.AdbError):
+        adb.decode(data[:40])
+
+
+@pytest.mark.skipif(shutil.which("apk") is None, reason="apk is not installed")
+def test_decode_apk(fixture):
+    # the decoder against the real thing, and the recorded output too
+    res = subprocess.run(["apk", "adbdump", str(fixture)], capture_output=True, check=True)
+    dump = parse_dump(res.stdout.splitlines(keepends=True))
+    assert adb.decode(fixture.read_bytes()) == dump
+    assert recorded(fixture) == dump
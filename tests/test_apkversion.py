@@ -0,0 +1,60 @@
+import shutil
+import pathlib
+import subprocess
+
+import pytest
+
+import apkversion
+
+DATA = pathlib.Path(__file__).parent / "data"
+
+INVERSE = {
+    apkversion.LESS: apkversion.GREATER,
+    apkversion.EQUAL: apkversion.EQUAL,
+    apkversion.GREATER: apkversion.LESS,
+}
+
+
+def load_pairs():
+    pairs = []
+    for line in (DATA / "versions.txt").read_text().splitlines():
+        if not line or line.startswith("#"):
+            continue
+        a, op, b = line.split()
+        pairs.append((a, op, b))
+    return pairs
+
+
+PAIRS = load_pairs()
+
+
+@pytest.mark.parametrize("a,op,b", PAIRS)
+def test_compare(a, op, b):
+    assert apkversion.compare(a, b) == op
+    assert apkversion.compare(b, a) == INVERSE[op]
+
+
+@pytest.mark.parametrize(
+    "ver,op,depver,result",
+    [
+        ("1.2.3-r0", None, None, True),
+        ("1.2.3-r0", ">=", "1.2", True),
+        ("1.2.3-r0", "<", "1.2", False),
+        ("1.2.3-r0", "~", "1.2", True),
+        ("1.3-r0", "~", "1.2", False),
+        ("1.2-r1", "=", "1.2-r1", True),
+        ("1.2-r1", "><", "abcdef", True),
+        (None, ">=", "1.0", False),
+        ("1.0", "?", "1.0", False),
+    ],
+)
+def test_satisfies(ver, op, depver, result):
+    assert apkversion.satisfies(ver, op, depver) == result
+
+
+@pytest.mark.skipif(shutil.which("apk") is None, reason="apk is not installed")
+@pytest.mark.parametrize("a,op,b", PAIRS)
+def test_compare_apk(a, op, b):
+    # the corpus is what apk says, so it must agree with the real thing
+    res = subprocess.run(["apk", "version", "-t", a, b], capture_output=True, text=True)
+    assert res.stdout.strip() == op
@@ -0,0 +1,40 @@
+import sqlite3
+import importlib.util
+import pathlib
+
+import export
+
+ROOT = pathlib.Path(__file__).parent.parent
+
+
+def load_updater():
+    # the file name has a dash in it, so it cannot simply be imported
+    spec = importlib.util.spec_from_file_location("update_database", ROOT / "update-database.py")
+    upd = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(upd)
+    return upd
+
+
+def make_db(files):
+    upd = load_updater()
+    db = sqlite3.connect(":memory:")
+    upd.create_tables(db)
+    fid = upd.store_file_list(db, files)
+    db.execute(
+        "INSERT INTO packages (name, version, arch, repo, fid) VALUES (?, ?, ?, ?, ?)",
+        ["foo", "1.0-r0", "x86_64", "main", fid],
+    )
+    return db
+
+
+def test_files():
+    files = ["/usr/bin/foo", "/usr/share/man/man1/foo.1"]
+    (package,) = export.iter_export(make_db(files), "main", "x86_64")
+    assert package["name"] == "foo"
+    assert package["files"] == files
+
+
+def test_root_files():
+    files = ["/.hidden", "/foo", "/usr/bin/foo"]
+    (package,) = export.iter_export(make_db(files), "main", "x86_64")
+    assert package["files"] == files
@@ -1,17 +1,96 @@
 import os
-import io
 import sys
+import gzip
+import argparse
+import hashlib
 import sqlite3
 import pathlib
+import tempfile
 import configparser
 import subprocess
 import time
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from email.utils import parseaddr
 
+import adb
+import export
+import apkversion
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 config = configparser.ConfigParser()
 config.read("config.ini")
 
 
+class PhaseTimer:
+    # wall time spent in each phase of an update; a phase entered within
+    # another is not counted towards the outer one, so that the phases add
+    # up to the whole run. only the main thread keeps time, the file lists
+    # fetched by the pool show up as the time spent waiting for them
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.times = collections.Counter()
+        self.stack = []
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            outer, since = self.stack[-1]
+            self.times[outer] += now - since
+        self.stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            name, since = self.stack.pop()
+            self.times[name] += now - since
+            if self.stack:
+                self.stack[-1][1] = now
+
+    def iter(self, name, items):
+        # times producing each item, not what the caller does with it
+        items = iter(items)
+        while True:
+            with self(name):
+                item = next(items, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+
+phases = PhaseTimer()
+
+
+session = None
+session_lock = threading.Lock()
+
+
+def get_session():
+    # one keep-alive session for all repository fetches, with enough
+    # pooled connections for every fetch thread
+    global session
+    with session_lock:
+        if session is None:
+            import requests
+
+            jobs = max(config.getint("settings", "fetch-jobs", fallback=4), 1)
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=jobs)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        return session
+
+
 def get_file(url):
     if url.startswith("file://"):
         try:
@@ -22,30 +101,194 @@ def get_file(url):
         except Exception:
             return (500, None)
     # actual url
-    import requests
-
-    req = requests.get(url)
+    req = get_session().get(url)
     if req.status_code == 200:
         return (200, req.content)
     else:
         return (req.status_code, None)
 
 
-def dump_adb(adbc, rootn=None):
+def get_adb_head(url):
+    # only the metadata at the start of a package is needed, so stop the
+    # transfer as soon as it has been read; None means it did not work
+    # out and the whole file should be fetched instead
+    reader = adb.AdbHeadReader()
+    try:
+        if url.startswith("file://"):
+            with open(url.removeprefix("file://"), "rb") as inf:
+                for chunk in iter(lambda: inf.read(65536), b""):
+                    if reader.feed(chunk):
+                        return reader.result
+            return None
+        # actual url
+        with get_session().get(url, stream=True) as req:
+            if req.status_code != 200:
+                return None
+            for chunk in req.iter_content(65536):
+                if reader.feed(chunk):
+                    return reader.result
+        return None
+    except adb.AdbError as e:
+        print(f"could not read metadata of {url}: {e}")
+        return None
+    except Exception:
+        return None
+
+
+def load_fetch_state(db):
+    # url -> (etag, last_modified, hash) of the indexes processed before
+    if db is None:
+        return {}
+    cur = db.cursor()
+    try:
+        cur.execute("SELECT url, etag, last_modified, hash FROM fetch_state")
+    except sqlite3.OperationalError:
+        # not created yet
+        return {}
+    return {url: tuple(state) for url, *state in cur.fetchall()}
+
+
+def get_index(url, state):
+    # fetches an index unless it is the same as when it was last processed,
+    # given its previous state from load_fetch_state(); returns (status,
+    # content, state) with status 304 when unchanged, and state to be
+    # stored with save_fetch_state() once it has been processed
+    etag, last_modified, ohash = state or (None, None, None)
+
+    if url.startswith("file://"):
+        status, content = get_file(url)
+        if status != 200:
+            return (status, None, None)
+        etag = last_modified = None
+    else:
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        req = get_session().get(url, headers=headers)
+        if req.status_code == 304:
+            return (304, None, None)
+        if req.status_code != 200:
+            return (req.status_code, None, None)
+        content = req.content
+        etag = req.headers.get("ETag", None)
+        last_modified = req.headers.get("Last-Modified", None)
+
+    # servers without validators still get caught by the hash
+    chash = hashlib.sha256(content).hexdigest()
+    state = (etag, last_modified, chash)
+    if chash == ohash:
+        return (304, None, state)
+    return (200, content, state)
+
+
+def save_fetch_state(db, url, state):
+    cur = db.cursor()
+    sql = """
+        INSERT OR REPLACE INTO fetch_state (url, etag, last_modified, hash)
+        VALUES (?, ?, ?, ?)
+    """
+    cur.execute(sql, [url, *state])
+
+
+def dump_adb(adbc, rootn=None, incremental=False):
+    # decode natively when we can, apk adbdump is the fallback for
+    # anything the decoder does not understand; in incremental mode,
+    # the items of the list in the rootn section are yielded one by one
+    if incremental:
+        return iter_adb(adbc, rootn)
+    try:
+        return adb.decode(adbc, rootn.decode().rstrip(":") if rootn else None)
+    except adb.AdbError as e:
+        print(f"using apk adbdump: {e}")
+    return dump_adb_apk(adbc, rootn)
+
+
+def iter_adb(adbc, rootn):
+    nitems = 0
+    try:
+        for item in adb.iter_decode(adbc, rootn.decode().rstrip(":")):
+            yield item
+            nitems += 1
+        return
+    except adb.AdbError as e:
+        print(f"using apk adbdump: {e}")
+    # pick up where the decoder gave up
+    yield from iter_adb_apk(adbc, rootn, nitems)
+
+
+def run_adbdump(adbc):
+    # yields the output lines of apk adbdump as they come
     apk_bin = config.get("settings", "apk", fallback="apk")
-    sp = subprocess.run(
-        [apk_bin, "adbdump", "/dev/stdin"], input=adbc, capture_output=True
+    sp = subprocess.Popen(
+        [apk_bin, "adbdump", "/dev/stdin"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
     )
+
+    # feed it from a thread, so neither side blocks on a full pipe
+    def feed():
+        try:
+            sp.stdin.write(adbc)
+            sp.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    try:
+        yield from sp.stdout
+    finally:
+        sp.stdout.close()
+        writer.join()
+        sp.wait()
     if sp.returncode != 0:
+        raise adb.AdbError(f"apk adbdump failed with {sp.returncode}")
+
+
+def dump_adb_apk(adbc, rootn=None):
+    root = {}
+    try:
+        for _ in parse_adbdump(run_adbdump(adbc), rootn, root):
+            pass
+    except adb.AdbError:
         return None
-    # root is a dict
-    adb = {}
-    adbstack = [(adb, None)]
+    return root
+
+
+def iter_adb_apk(adbc, rootn, skip=0):
+    root = {}
+    key = rootn.decode().rstrip(":")
+    done = 0
+    for _ in parse_adbdump(run_adbdump(adbc), rootn, root):
+        items = root.get(key, None)
+        if not isinstance(items, list):
+            continue
+        # all but the last item are complete, and get dropped once yielded
+        while done < len(items) - 1:
+            if done >= skip:
+                yield items[done]
+            items[done] = None
+            done += 1
+    for item in root.get(key, [])[done:]:
+        if done >= skip:
+            yield item
+        done += 1
+
+
+def parse_adbdump(lines, rootn, root):
+    # parses the text output of apk adbdump into root, yielding after
+    # every line so that callers can consume the result incrementally
+    adbstack = [(root, None)]
     depth = 0
     # whether we're in the section we need
     insect = not rootn
     # read line by line
-    for ln in io.BytesIO(sp.stdout):
+    for ln in lines:
+        # hand control back to the caller between lines
+        yield
         ol = ln
         if ln.startswith(b"#"):
             continue
@@ -79,7 +322,7 @@ def dump_adb(adbc, rootn=None):
         if ln.startswith(b"- "):
             # list item
             if not isinstance(st, list):
-                return None
+                raise adb.AdbError("unexpected list item")
             ln = ln.removeprefix(b"- ")
             # there may be a dict or string as the list element
             if ln.endswith(b":") or ln.find(b": ") > 0:
@@ -102,10 +345,10 @@ def dump_adb(adbc, rootn=None):
                 continue
         # not a list item, so get key and value
         if not isinstance(st, dict):
-            return None
+            raise adb.AdbError("unexpected key")
         kend = ln.find(b":")
         if kend < 0:
-            return None
+            raise adb.AdbError("missing key")
         key = ln[0:kend].decode()
         val = ln[kend + 1 :].lstrip()
         # no value means we are starting a new dict
@@ -131,13 +374,33 @@ def dump_adb(adbc, rootn=None):
             continue
         # plain value
         st[key] = val.decode(errors="replace")
-    # done
-    return adb
+    # decode long strings that run until the end
+    while len(adbstack) > 1:
+        if isinstance(adbstack[-1][0], bytearray):
+            adbstack[-2][0][adbstack[-1][1]] = adbstack[-1][0].decode(
+                errors="ignore"
+            )
+        adbstack.pop()
 
 
 def set_options(db):
     cur = db.cursor()
     cur.execute("PRAGMA journal_mode = WAL")
+    # make the ON DELETE CASCADE clauses in the schema actually apply
+    cur.execute("PRAGMA foreign_keys = ON")
+
+
+NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+BUMP_GENERATION = [
+    "UPDATE meta SET value = value + 1 WHERE key = 'generation'",
+    f"UPDATE meta SET value = {NOW} WHERE key = 'updated'",
+]
+
+
+def bump_generation(db):
+    cur = db.cursor()
+    for sql in BUMP_GENERATION:
+        cur.execute(sql)
 
 
 def create_tables(db):
@@ -167,18 +430,36 @@ def create_tables(db):
         "CREATE INDEX IF NOT EXISTS 'packages_name' on 'packages' (name)",
         "CREATE INDEX IF NOT EXISTS 'packages_maintainer' on 'packages' (maintainer)",
         "CREATE INDEX IF NOT EXISTS 'packages_build_time' on 'packages' (build_time)",
+        # the listing order, so keyset pagination can seek into it
+        "CREATE INDEX IF NOT EXISTS 'packages_listing' on 'packages' (build_time DESC, name, id)",
         "CREATE INDEX IF NOT EXISTS 'packages_origin' on 'packages' (origin)",
+        "CREATE INDEX IF NOT EXISTS 'packages_fid' on 'packages' (fid)",
+        # file lists are interned by content and shared by all packages
+        # with the same list (usually the same package on every arch),
+        # with the directories interned separately
+        """
+            CREATE TABLE IF NOT EXISTS 'dirs' (
+                'id' INTEGER PRIMARY KEY,
+                'path' TEXT UNIQUE
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS 'filelists' (
+                'id' INTEGER PRIMARY KEY,
+                'hash' TEXT UNIQUE
+            )
+        """,
         """
             CREATE TABLE IF NOT EXISTS 'files' (
                 'id' INTEGER PRIMARY KEY,
                 'file' TEXT,
-                'path' TEXT,
-                'pid' INTEGER REFERENCES packages(id) ON DELETE CASCADE
+                'did' INTEGER REFERENCES dirs(id),
+                'fid' INTEGER REFERENCES filelists(id) ON DELETE CASCADE
             )
         """,
         "CREATE INDEX IF NOT EXISTS 'files_file' on 'files' (file)",
-        "CREATE INDEX IF NOT EXISTS 'files_path' on 'files' (path)",
-        "CREATE INDEX IF NOT EXISTS 'files_pid' on 'files' (pid)",
+        "CREATE INDEX IF NOT EXISTS 'files_did' on 'files' (did)",
+        "CREATE INDEX IF NOT EXISTS 'files_fid' on 'files' (fid)",
         """
             CREATE TABLE IF NOT EXISTS maintainer (
                 'id' INTEGER PRIMARY KEY,
@@ -202,6 +483,31 @@ def create_tables(db):
         """,
     ]
 
+    # the generation is bumped whenever the data the web frontend shows
+    # changes, see bump_generation(); flags come from elsewhere, so they
+    # bump it on their own
+    schema += [
+        """
+            CREATE TABLE IF NOT EXISTS 'meta' (
+                'key' TEXT PRIMARY KEY,
+                'value' INTEGER
+            )
+        """,
+        f"""
+            INSERT OR IGNORE INTO meta (key, value)
+            VALUES ('generation', 0), ('updated', {NOW})
+        """,
+    ]
+    for event in ["insert", "update", "delete"]:
+        schema += [
+            f"""
+                CREATE TRIGGER IF NOT EXISTS 'flagged_{event}_generation'
+                AFTER {event.upper()} ON flagged BEGIN
+                    {"; ".join(BUMP_GENERATION)};
+                END
+            """,
+        ]
+
     fields = ["provides", "depends", "install_if"]
     for field in fields:
         schema += [
@@ -217,25 +523,202 @@ def create_tables(db):
             f"CREATE INDEX IF NOT EXISTS '{field}_pid' on {field} (pid)",
         ]
 
+    # dependencies resolved to the providing package (NULL if none), kept
+    # up to date by update_resolved_depends()
+    schema += [
+        """
+            CREATE TABLE IF NOT EXISTS 'resolved_depends' (
+                'pid' INTEGER REFERENCES packages(id) ON DELETE CASCADE,
+                'depname' TEXT,
+                'target_pid' INTEGER
+            )
+        """,
+        "CREATE INDEX IF NOT EXISTS 'resolved_depends_pid' on resolved_depends (pid)",
+        # every package satisfying a dependency of pid, honouring the
+        # version constraints; this is what "Required by" shows
+        """
+            CREATE TABLE IF NOT EXISTS 'reverse_depends' (
+                'target_pid' INTEGER REFERENCES packages(id) ON DELETE CASCADE,
+                'pid' INTEGER REFERENCES packages(id) ON DELETE CASCADE,
+                PRIMARY KEY ('target_pid', 'pid')
+            ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS 'reverse_depends_pid' on reverse_depends (pid)",
+    ]
+
+    # validators of the fetched indexes, see get_index()
+    schema += [
+        """
+            CREATE TABLE IF NOT EXISTS 'fetch_state' (
+                'url' TEXT PRIMARY KEY,
+                'etag' TEXT,
+                'last_modified' TEXT,
+                'hash' TEXT
+            )
+        """,
+    ]
+
+    # package counts per facet combination, see update_package_counts()
+    schema += [
+        """
+            CREATE TABLE IF NOT EXISTS 'package_counts' (
+                'repo' TEXT,
+                'arch' TEXT,
+                'maintainer' INTEGER,
+                'is_origin' INTEGER,
+                'qty' INTEGER
+            )
+        """,
+    ]
+
+    # trigram indexes over file names and paths for substring searches,
+    # kept in sync with the files and dirs tables by the triggers
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'files_fts'")
+    fts_missing = cur.fetchone() is None
+    for table, column in [("files", "file"), ("dirs", "path")]:
+        schema += [
+            f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS '{table}_fts' USING fts5(
+                    {column},
+                    content='{table}', content_rowid='id',
+                    tokenize='trigram case_sensitive 1'
+                )
+            """,
+            f"""
+                CREATE TRIGGER IF NOT EXISTS '{table}_fts_insert'
+                AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {table}_fts (rowid, {column})
+                    VALUES (new.id, new.{column});
+                END
+            """,
+            f"""
+                CREATE TRIGGER IF NOT EXISTS '{table}_fts_delete'
+                AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {table}_fts ({table}_fts, rowid, {column})
+                    VALUES ('delete', old.id, old.{column});
+                END
+            """,
+        ]
+
+    old_files = migrate_files_prepare(db)
+
     for sql in schema:
         cur.execute(sql)
 
+    if old_files:
+        migrate_files(db)
 
-def ensure_maintainer_exists(db, maintainer):
+    if fts_missing or old_files:
+        print("building file search index")
+        cur.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+        cur.execute("INSERT INTO dirs_fts (dirs_fts) VALUES ('rebuild')")
+
+
+# secondary indexes and triggers that adding packages does not read from;
+# create_tables() puts them back
+BULK_INDEXES = [
+    "packages_maintainer",
+    "packages_build_time",
+    "packages_listing",
+    "packages_origin",
+    "packages_fid",
+    "files_file",
+    "files_did",
+    "files_fid",
+]
+BULK_TRIGGERS = ["files_fts_insert", "dirs_fts_insert"]
+
+
+def drop_bulk_indexes(db):
+    cur = db.cursor()
+    for index in BULK_INDEXES:
+        cur.execute(f"DROP INDEX IF EXISTS '{index}'")
+    for trigger in BULK_TRIGGERS:
+        cur.execute(f"DROP TRIGGER IF EXISTS '{trigger}'")
+
+
+def rebuild_bulk_indexes(db):
+    print("building indexes")
+    start = time.monotonic()
+    create_tables(db)
+    # the search index missed every insert while its triggers were gone
+    cur = db.cursor()
+    cur.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+    cur.execute("INSERT INTO dirs_fts (dirs_fts) VALUES ('rebuild')")
+    print(f"built indexes in {time.monotonic() - start:.1f}s")
+
+
+def migrate_files_prepare(db):
+    # files used to be stored per package along with the full directory;
+    # move that table out of the way so the new schema can be created
+    cur = db.cursor()
+    cur.execute("PRAGMA table_info('files')")
+    if "pid" not in map(lambda x: x[1], cur.fetchall()):
+        return False
+    for trigger in ["files_fts_insert", "files_fts_delete"]:
+        cur.execute(f"DROP TRIGGER IF EXISTS '{trigger}'")
+    cur.execute("DROP TABLE IF EXISTS files_fts")
+    for index in ["files_file", "files_path", "files_pid"]:
+        cur.execute(f"DROP INDEX IF EXISTS '{index}'")
+    cur.execute("ALTER TABLE files RENAME TO files_old")
+    return True
+
+
+def migrate_files(db):
+    print("migrating file lists")
+    cur = db.cursor()
+    sql = """
+        SELECT files_old.pid, files_old.path, files_old.file
+        FROM files_old
+        JOIN packages ON packages.id = files_old.pid
+        ORDER BY files_old.pid, files_old.id
+    """
+    rows = cur.execute(sql)
+    wcur = db.cursor()
+
+    def flush(pid, files):
+        fid = store_file_list(db, files)
+        wcur.execute("UPDATE packages SET fid = ? WHERE id = ?", [fid, pid])
+
+    lpid = None
+    files = []
+    for pid, path, file in rows:
+        if pid != lpid and lpid is not None:
+            flush(lpid, files)
+            files = []
+        lpid = pid
+        files.append(os.path.join(path, file))
+    if lpid is not None:
+        flush(lpid, files)
+
+    cur.execute("DROP TABLE files_old")
+
+
+def load_maintainers(db):
+    # (name, email) -> id for everyone already known, so that adding
+    # packages does not have to query or rewrite the maintainer table
+    cur = db.cursor()
+    cur.execute("SELECT name, email, id FROM maintainer")
+    return {(name, email): idn for name, email, idn in cur.fetchall()}
+
+
+def ensure_maintainer_exists(db, maintainers, maintainer):
     name, email = parseaddr(maintainer)
 
     if not email:
         return
 
+    idn = maintainers.get((name, email), None)
+    if idn is not None:
+        return idn
+
     sql = """
-        INSERT OR REPLACE INTO maintainer ('id', 'name', 'email')
-        VALUES (
-            (SELECT id FROM maintainer WHERE name=? and email=?),
-            ?, ?
-        )
+        INSERT INTO maintainer ('name', 'email')
+        VALUES (?, ?)
     """
     cursor = db.cursor()
-    cursor.execute(sql, [name, email, name, email])
+    cursor.execute(sql, [name, email])
+    maintainers[(name, email)] = cursor.lastrowid
     return cursor.lastrowid
 
 
@@ -249,8 +732,11 @@ def parse_version_operator(package):
 
 
 def get_file_list(url):
-    print(f"getting file list for {url}")
-    rescode, rescontent = get_file(url)
+    # one write, so lines from the fetch threads do not interleave
+    print(f"getting file list for {url}\n", end="")
+    rescontent = get_adb_head(url)
+    if rescontent is None:
+        rescode, rescontent = get_file(url)
     if not rescontent:
         rescontent = b""
     adbc = dump_adb(rescontent, b"paths:")
@@ -268,27 +754,115 @@ def get_file_list(url):
     return result
 
 
-def add_packages(db, branch, repo, arch, packages, changed):
+def store_file_list(db, files):
+    # returns the id of the shared file list with exactly these files
+    if not files:
+        return None
+    files = sorted(set(files))
+    flhash = hashlib.sha256("\n".join(files).encode()).hexdigest()
+
     cur = db.cursor()
-    for pkg in changed:
-        print(f"adding {pkg}")
-        package = packages[pkg]
-        if "maintainer" in package:
-            maintainer_id = ensure_maintainer_exists(db, package["maintainer"])
-        else:
-            maintainer_id = None
+    cur.execute("SELECT id FROM filelists WHERE hash = ?", [flhash])
+    row = cur.fetchone()
+    if row is not None:
+        return row[0]
+
+    cur.execute("INSERT INTO filelists (hash) VALUES (?)", [flhash])
+    fid = cur.lastrowid
+
+    dirs = {}
+    filerows = []
+    for file in files:
+        fpath = os.path.dirname(file)
+        did = dirs.get(fpath, None)
+        if did is None:
+            cur.execute("INSERT OR IGNORE INTO dirs (path) VALUES (?)", [fpath])
+            cur.execute("SELECT id FROM dirs WHERE path = ?", [fpath])
+            did = dirs[fpath] = cur.fetchone()[0]
+        filerows.append([os.path.basename(file), did, fid])
+    sql = """
+        INSERT INTO 'files' (
+            "file", "did", "fid"
+        )
+        VALUES (?, ?, ?)
+    """
+    cur.executemany(sql, filerows)
+    return fid
+
+
+def fetch_file_lists(branch, repo, arch, packages):
+    # yields (package, files) in order while a pool of threads fetches
+    # ahead; the window keeps the number of lists held in memory bounded
+    url = config.get("repository", "url")
+    jobs = max(config.getint("settings", "fetch-jobs", fallback=4), 1)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = collections.deque()
+        for package in packages:
+            apk_url = (
+                f'{url}/{branch}/{repo}/{arch}/{package["name"]}-{package["version"]}.apk'
+            )
+            pending.append((package, pool.submit(get_file_list, apk_url)))
+            if len(pending) >= jobs * 4:
+                package, fut = pending.popleft()
+                with phases("fetch"):
+                    files = fut.result()
+                yield package, files
+        while pending:
+            package, fut = pending.popleft()
+            with phases("fetch"):
+                files = fut.result()
+            yield package, files
+
+
+def add_packages(db, maintainers, branch, repo, arch, packages):
+    cur = db.cursor()
+    pids = []
+    start = time.monotonic()
+    changes = db.total_changes
+
+    # ids are handed out here so that the rows referencing a package can
+    # be batched along with it; we are the only writer
+    cur.execute("SELECT coalesce(max(id), 0) FROM packages")
+    pid = cur.fetchone()[0]
+
+    pkgrows = []
+    fieldrows = {"provides": [], "install_if": [], "depends": []}
 
+    def flush():
         sql = """
             INSERT INTO 'packages' (
-                name, version, description, url, license, arch,
+                id, name, version, description, url, license, arch,
                 repo, unique_id, size, installed_size, origin,
-                maintainer, build_time, "commit", provider_priority
+                maintainer, build_time, "commit", provider_priority, fid
             )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
-        cur.execute(
-            sql,
+        cur.executemany(sql, pkgrows)
+        pkgrows.clear()
+        for field, rows in fieldrows.items():
+            sql = f"""
+                INSERT INTO {field} (name, version, operator, pid) VALUES (?, ?, ?, ?)
+            """
+            cur.executemany(sql, rows)
+            rows.clear()
+
+    # all database writes stay on this thread
+    for package, files in fetch_file_lists(branch, repo, arch, packages):
+        print(f'adding {package["name"]}-{package["version"]}')
+        if "maintainer" in package:
+            maintainer_id = ensure_maintainer_exists(
+                db, maintainers, package["maintainer"]
+            )
+        else:
+            maintainer_id = None
+
+        fid = store_file_list(db, files)
+
+        pid += 1
+        pids.append(pid)
+        pkgrows.append(
             [
+                pid,
                 package["name"],
                 package["version"],
                 package["description"],
@@ -304,72 +878,228 @@ def add_packages(db, branch, repo, arch, packages, changed):
                 package["build-time"],
                 package.get("repo-commit", "unknown"),
                 package.get("provider-priority", None),
-            ],
+                fid,
+            ]
         )
-        pid = cur.lastrowid
 
-        for provide in package.get("provides", []):
-            name, operator, ver = parse_version_operator(provide)
-            sql = """
-                INSERT INTO provides (name, version, operator, pid) VALUES (?, ?, ?, ?)
-            """
-            cur.execute(sql, [name, ver, operator, pid])
+        for field, key in [
+            ("provides", "provides"),
+            ("install_if", "install-if"),
+            ("depends", "depends"),
+        ]:
+            for dep in package.get(key, []):
+                name, operator, ver = parse_version_operator(dep)
+                fieldrows[field].append([name, ver, operator, pid])
 
-        for iif in package.get("install-if", []):
-            name, operator, ver = parse_version_operator(iif)
-            sql = """
-                INSERT INTO install_if (name, version, operator, pid) VALUES (?, ?, ?, ?)
-            """
-            cur.execute(sql, [name, ver, operator, pid])
+        if len(pkgrows) >= 256:
+            flush()
 
-        for dep in package.get("depends", []):
-            name, operator, ver = parse_version_operator(dep)
-            sql = """
-                INSERT INTO depends (name, version, operator, pid) VALUES (?, ?, ?, ?)
-            """
-            cur.execute(sql, [name, ver, operator, pid])
+    flush()
 
-        url = config.get("repository", "url")
-        apk_url = (
-            f'{url}/{branch}/{repo}/{arch}/{package["name"]}-{package["version"]}.apk'
+    if pids:
+        elapsed = time.monotonic() - start
+        rows = db.total_changes - changes
+        print(
+            f"added {len(pids)} packages, {rows} rows in {elapsed:.1f}s"
+            f" ({rows / max(elapsed, 0.001):.0f} rows/s)"
         )
-        files = get_file_list(apk_url)
-        filerows = []
-        for file in files:
-            fname = os.path.basename(file)
-            fpath = os.path.dirname(file)
-            filerows.append([fname, fpath, pid])
-        sql = """
-            INSERT INTO 'files' (
-                "file", "path", "pid"
-            )
-            VALUES (?, ?, ?)
-        """
-        cur.executemany(sql, filerows)
+
+    return pids
 
 
 def del_packages(db, repo, arch, remove):
     cur = db.cursor()
+    # (arch, name) pairs that the removed packages provided
+    names = set()
     for package in remove:
         print(f"removing {package}")
         part = package.split("-")
         name = "-".join(part[:-2])
         ver = "-".join(part[-2:])
         sql = """
-            DELETE FROM packages
+            SELECT id, arch, name
+            FROM packages
             WHERE repo = ?
                 AND arch = ?
                 AND name = ?
                 AND version = ?
         """
         cur.execute(sql, [repo, arch, name, ver])
-        if cur.rowcount != 1:
+        rows = cur.fetchall()
+        if len(rows) != 1:
             print(f"could not remove {name}={ver} from {repo}/{arch}")
+        for pid, parch, pname in rows:
+            names.add((parch, pname))
+            cur.execute("SELECT name FROM provides WHERE pid = ?", [pid])
+            for (prname,) in cur.fetchall():
+                names.add((parch, prname))
+            cur.execute("DELETE FROM packages WHERE id = ?", [pid])
+    return names
 
 
-def update_v2index(db, repo, arch):
+def compare_provider_versions(a, b):
+    # unversioned provides always lose against versioned ones
+    if a is None or b is None:
+        if a is None and b is None:
+            return apkversion.EQUAL
+        return apkversion.LESS if a is None else apkversion.GREATER
+    return apkversion.compare(a, b)
+
+
+def better_provider(old, new):
+    # candidates are (pid, version, provider_priority); the highest version
+    # wins, and provider_priority breaks ties
+    if old is None:
+        return new
+    cmp = compare_provider_versions(old[1], new[1])
+    if cmp == apkversion.LESS:
+        return new
+    if cmp == apkversion.EQUAL:
+        oprio = old[2] if old[2] is not None else -1
+        nprio = new[2] if new[2] is not None else -1
+        if int(nprio) > int(oprio):
+            return new
+    return old
+
+
+def resolve_depends(db, pids):
+    cur = db.cursor()
+
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS resolve_pids (pid INTEGER PRIMARY KEY)")
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS resolve_names (arch TEXT, name TEXT, PRIMARY KEY (arch, name))")
+    cur.execute("DELETE FROM resolve_pids")
+    cur.execute("DELETE FROM resolve_names")
+    cur.executemany("INSERT OR IGNORE INTO resolve_pids VALUES (?)", [(p,) for p in pids])
+
+    # dependencies in their original order, which is what gets displayed
+    sql = """
+        SELECT depends.pid, packages.arch, depends.name, depends.operator,
+            depends.version
+        FROM depends
+        JOIN resolve_pids ON resolve_pids.pid = depends.pid
+        JOIN packages ON packages.id = depends.pid
+        ORDER BY depends.rowid
+    """
+    cur.execute(sql)
+    deps = cur.fetchall()
+    cur.executemany(
+        "INSERT OR IGNORE INTO resolve_names VALUES (?, ?)",
+        [(dep[1], dep[2]) for dep in deps],
+    )
+
+    # all candidates as (pid, version, provider_priority) per (arch, name)
+    sql = """
+        SELECT packages.arch, packages.name, packages.id, packages.version,
+            packages.provider_priority
+        FROM packages
+        JOIN resolve_names ON resolve_names.arch = packages.arch
+            AND resolve_names.name = packages.name
+    """
+    direct = {}
+    cur.execute(sql)
+    for parch, pname, pid, pver, pprio in cur.fetchall():
+        direct.setdefault((parch, pname), []).append((pid, pver, pprio))
+
+    sql = """
+        SELECT packages.arch, provides.name, packages.id, provides.version,
+            packages.provider_priority
+        FROM provides
+        JOIN packages ON packages.id = provides.pid
+        JOIN resolve_names ON resolve_names.arch = packages.arch
+            AND resolve_names.name = provides.name
+    """
+    provided = {}
+    cur.execute(sql)
+    for parch, pname, pid, pver, pprio in cur.fetchall():
+        provided.setdefault((parch, pname), []).append((pid, pver, pprio))
+
+    rows = []
+    reverse = set()
+    for pid, darch, dname, dop, dver in deps:
+        key = (darch, dname)
+        target = None
+        # a package of that name always wins over other providers
+        for cands in (direct.get(key, []), provided.get(key, [])):
+            best = None
+            for cand in cands:
+                if not apkversion.satisfies(cand[1], dop, dver):
+                    continue
+                reverse.add((cand[0], pid))
+                best = better_provider(best, cand)
+            if target is None:
+                target = best
+        rows.append([pid, dname, target[0] if target else None])
+
+    cur.execute("DELETE FROM resolved_depends WHERE pid IN (SELECT pid FROM resolve_pids)")
+    cur.executemany(
+        "INSERT INTO resolved_depends (pid, depname, target_pid) VALUES (?, ?, ?)",
+        rows,
+    )
+    cur.execute("DELETE FROM reverse_depends WHERE pid IN (SELECT pid FROM resolve_pids)")
+    cur.executemany(
+        "INSERT INTO reverse_depends (target_pid, pid) VALUES (?, ?)",
+        reverse,
+    )
+
+
+def update_resolved_depends(db, added, names):
+    # re-resolve the new packages, plus everything depending on a name that
+    # was provided by any package that came or went
+    cur = db.cursor()
+
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS changed_names (arch TEXT, name TEXT, PRIMARY KEY (arch, name))")
+    cur.execute("DELETE FROM changed_names")
+    cur.executemany("INSERT OR IGNORE INTO changed_names VALUES (?, ?)", names)
+    for pid in added:
+        sql = """
+            INSERT OR IGNORE INTO changed_names
+            SELECT arch, name FROM packages WHERE id = ?
+            UNION
+            SELECT packages.arch, provides.name
+            FROM provides
+            JOIN packages ON packages.id = provides.pid
+            WHERE provides.pid = ?
+        """
+        cur.execute(sql, [pid, pid])
+
+    sql = """
+        SELECT DISTINCT depends.pid
+        FROM depends
+        JOIN packages ON packages.id = depends.pid
+        JOIN changed_names ON changed_names.arch = packages.arch
+            AND changed_names.name = depends.name
+    """
+    cur.execute(sql)
+    pids = set(added)
+    pids.update(map(lambda x: x[0], cur.fetchall()))
+
+    if pids:
+        print(f"resolving dependencies of {len(pids)} packages")
+        resolve_depends(db, pids)
+
+
+def ensure_resolved_depends(db):
+    # databases from before the resolved tables existed get a full pass
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM resolved_depends LIMIT 1")
+    has_resolved = cur.fetchone() is not None
+    cur.execute("SELECT 1 FROM reverse_depends LIMIT 1")
+    if has_resolved and cur.fetchone() is not None:
+        return
+    cur.execute("SELECT id FROM packages")
+    pids = list(map(lambda x: x[0], cur.fetchall()))
+    if pids:
+        print(f"resolving dependencies of all {len(pids)} packages")
+        resolve_depends(db, pids)
+
+
+def get_v2index_path(repo, arch):
     cachev = config.get('settings', 'apkindex-cache', fallback='apkindex_cache')
-    icache = pathlib.Path(cachev) / f"apkindex_{repo.replace('/', '_')}_{arch}.txt"
+    return pathlib.Path(cachev) / f"apkindex_{repo.replace('/', '_')}_{arch}.txt"
+
+
+def update_v2index(db, repo, arch):
+    icache = get_v2index_path(repo, arch)
 
     cur = db.cursor()
 
@@ -394,49 +1124,109 @@ def update_v2index(db, repo, arch):
         "build_time": "t",
     }
 
+    lines = []
+    for row in cur.fetchall():
+        for i in range(len(fields)):
+            idxn = mappings.get(fields[i], None)
+            if idxn is None:
+                continue
+            lines.append(f"{idxn}:{str(row[i]).strip()}\n")
+        lines.append("\n")
+    data = "".join(lines).encode()
+
     icache.parent.mkdir(parents=True, exist_ok=True)
-    icache.unlink(missing_ok=True)
 
-    with open(icache, "w") as outf:
-        for row in cur.fetchall():
-            for i in range(len(fields)):
-                idxn = mappings.get(fields[i], None)
-                if idxn is None:
-                    continue
-                outf.write(f"{idxn}:{str(row[i]).strip()}\n")
-            outf.write("\n")
+    try:
+        unchanged = icache.read_bytes() == data
+    except FileNotFoundError:
+        unchanged = False
 
+    # precompressed variants go first, so that the plain file is never
+    # newer than them; gzip without a timestamp so the output is stable
+    variants = [(".gz", lambda d: gzip.compress(d, 9, mtime=0))]
+    if zstandard:
+        variants.append((".zst", zstandard.ZstdCompressor(level=19).compress))
+    else:
+        # left from a run that had zstandard, it would go stale, and the
+        # web frontend prefers it
+        icache.with_name(icache.name + ".zst").unlink(missing_ok=True)
+    for suffix, compress in variants:
+        path = icache.with_name(icache.name + suffix)
+        if unchanged and path.exists():
+            continue
+        replace_file(path, compress(data))
 
-def process_apkindex(db, branch, repo, arch, contents):
-    adbc = dump_adb(contents)
-    packages = {}
+    if not unchanged:
+        replace_file(icache, data)
 
-    for p in adbc.get("packages", []):
-        packages[f"{p['name']}-{p['version']}"] = p
+
+def replace_file(path, data):
+    # readers see either the old or the new file, never a partial one
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "wb") as outf:
+            outf.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def process_apkindex(db, maintainers, branch, repo, arch, contents):
+    cur = db.cursor()
+
+    # ids of the packages that are still in the index
+    cur.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS seen_packages (id INTEGER PRIMARY KEY)"
+    )
+    cur.execute("DELETE FROM seen_packages")
+
+    def new_packages():
+        sql = """
+            SELECT id
+            FROM packages
+            WHERE name = ?
+                AND version = ?
+                AND repo = ?
+                AND arch = ?
+        """
+        lcur = db.cursor()
+        packages = dump_adb(contents, b"packages:", incremental=True)
+        for p in phases.iter("adbdump", packages):
+            lcur.execute(sql, [p["name"], p["version"], repo, arch])
+            row = lcur.fetchone()
+            if row is None:
+                yield p
+            else:
+                lcur.execute("INSERT OR IGNORE INTO seen_packages VALUES (?)", row)
+
+    with phases("insert"):
+        added = add_packages(db, maintainers, branch, repo, arch, new_packages())
+    cur.executemany(
+        "INSERT OR IGNORE INTO seen_packages VALUES (?)", [(p,) for p in added]
+    )
 
     sql = """
         SELECT packages.name || '-' || packages.version
         FROM packages
         WHERE repo = ?
             AND arch = ?
+            AND id NOT IN (SELECT id FROM seen_packages)
     """
-    cur = db.cursor()
     cur.execute(sql, [repo, arch])
+    with phases("insert"):
+        removed = del_packages(
+            db, repo, arch, list(map(lambda x: x[0], cur.fetchall()))
+        )
 
-    local = set(map(lambda x: x[0], cur.fetchall()))
-    remote = set(packages.keys())
+    with phases("depends"):
+        update_resolved_depends(db, added, removed)
 
-    add_packages(
-        db,
-        branch,
-        repo,
-        arch,
-        packages,
-        remote - local,
-    )
-    del_packages(db, repo, arch, local - remote)
+    with phases("v2index"):
+        update_v2index(db, repo, arch)
 
-    update_v2index(db, repo, arch)
+    return bool(added or removed)
 
 
 def prune_maintainers(db):
@@ -467,19 +1257,377 @@ def prune_maintainers(db):
         cur.execute(sql, [idn])
 
 
-def generate(branch, archs):
-    url = config.get("repository", "url")
-    dbp = config.get("database", "path")
+def prune_file_lists(db):
+    cur = db.cursor()
 
-    db = sqlite3.connect(
-        os.path.join(dbp, f"cports-{branch}.db"),
+    # the files go along with their list
+    sql = """
+        DELETE FROM filelists
+        WHERE id NOT IN (
+            SELECT fid FROM packages WHERE fid IS NOT NULL
+        )
+    """
+    cur.execute(sql, [])
+    if cur.rowcount > 0:
+        print(f"pruned {cur.rowcount} file lists")
+
+    sql = """
+        DELETE FROM dirs
+        WHERE id NOT IN (
+            SELECT did FROM files
+        )
+    """
+    cur.execute(sql, [])
+
+
+def update_package_counts(db):
+    cur = db.cursor()
+
+    cur.execute("DELETE FROM package_counts")
+
+    sql = """
+        INSERT INTO package_counts (repo, arch, maintainer, is_origin, qty)
+        SELECT repo, arch, maintainer, origin = name, count(*)
+        FROM packages
+        GROUP BY repo, arch, maintainer, origin = name
+    """
+    cur.execute(sql, [])
+
+
+def ensure_package_counts(db):
+    # databases from before the counts existed, or from runs that did not
+    # change anything since, get them filled in; returns whether it did
+    cur = db.cursor()
+    cur.execute("SELECT 1 FROM package_counts LIMIT 1")
+    if cur.fetchone() is not None:
+        return False
+    cur.execute("SELECT 1 FROM packages LIMIT 1")
+    if cur.fetchone() is None:
+        return False
+    print("counting packages")
+    update_package_counts(db)
+    return True
+
+
+def connect(path):
+    return sqlite3.connect(
+        path,
         # when 3.12, use this instead of isolation_level
         # autocommit=True,
         isolation_level=None,
         timeout=5.0,
     )
 
+
+def fetch_indexes(db, branch, archs, jobs=1):
+    # downloads every index up front, before anything is written
+    url = config.get("repository", "url")
+    repos = config.get("repository", "repos").split(",")
+    if not archs:
+        archs = config.get("repository", "arches").split(",")
+
+    states = load_fetch_state(db)
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        pending = []
+        for repo in repos:
+            for arch in archs:
+                apkindex_url = f"{url}/{branch}/{repo}/{arch}/APKINDEX.tar.gz"
+                fut = pool.submit(get_index, apkindex_url, states.get(apkindex_url))
+                pending.append((repo, arch, apkindex_url, fut))
+
+        indexes = []
+        for repo, arch, apkindex_url, fut in pending:
+            idxstatus, idxcontent, idxstate = fut.result()
+            if idxstatus not in (200, 304):
+                print(f"skipping {arch}, {apkindex_url} returned {idxstatus}")
+                continue
+            indexes.append((repo, arch, apkindex_url, idxstatus, idxcontent, idxstate))
+    return indexes
+
+
+def needs_update(indexes):
+    for repo, arch, apkindex_url, idxstatus, idxcontent, idxstate in indexes:
+        if idxstatus == 200 or not get_v2index_path(repo, arch).exists():
+            return True
+    return False
+
+
+def update_database(db, branch, indexes):
+    cur = db.cursor()
+
+    create_tables(db)
+    with phases("depends"):
+        ensure_resolved_depends(db)
+    with phases("prune"):
+        recounted = ensure_package_counts(db)
+
+    maintainers = load_maintainers(db)
+
+    # an initial import is quicker with the indexes built afterwards
+    cur.execute("SELECT 1 FROM packages LIMIT 1")
+    bulk = cur.fetchone() is None
+    if bulk:
+        drop_bulk_indexes(db)
+
+    changed = set()
+    for repo, arch, apkindex_url, idxstatus, idxcontent, idxstate in indexes:
+        if idxstatus == 200:
+            print(f"parsing {repo}/{arch} APKINDEX")
+            if process_apkindex(db, maintainers, branch, repo, arch, idxcontent):
+                changed.add((repo, arch))
+        else:
+            print(f"skipping {repo}/{arch}, APKINDEX unchanged")
+            if not get_v2index_path(repo, arch).exists():
+                with phases("v2index"):
+                    update_v2index(db, repo, arch)
+        if idxstate:
+            save_fetch_state(db, apkindex_url, idxstate)
+
+    if bulk:
+        with phases("indexes"):
+            rebuild_bulk_indexes(db)
+
+    # pages showing the counts have to be redone when they were missing
+    if changed or recounted:
+        bump_generation(db)
+
+    # nothing else needs redoing when no index changed
+    if changed:
+        with phases("prune"):
+            prune_maintainers(db)
+            prune_file_lists(db)
+            update_package_counts(db)
+
+    with phases("export"):
+        update_exports(db, branch, [(i[0], i[1]) for i in indexes], changed)
+
+
+def get_generation(db):
+    cur = db.cursor()
+    cur.execute("SELECT value FROM meta WHERE key = 'generation'")
+    return cur.fetchone()[0]
+
+
+def update_exports(db, branch, repoarchs, changed, force=False):
+    # exports are named after the generation, so the web frontend can
+    # tell whether they are current; those of repos/archs that did not
+    # change are carried over to the new generation with a hard link, and
+    # the previous generation is kept until the next run for readers of
+    # a database that has not been swapped in yet
+    exportd = config.get("settings", "export-dir", fallback=None)
+    if not exportd:
+        return
+    generation = get_generation(db)
+    for repo, arch in repoarchs:
+        path = export.get_export_path(exportd, branch, repo, arch, generation)
+        pattern = export.get_export_path(exportd, branch, repo, arch, "*").name
+        stale = sorted(
+            (p for p in path.parent.glob(pattern) if p != path),
+            key=lambda p: int(p.name.split(".")[-3]),
+        )
+        if path.exists() and not force:
+            pass
+        elif stale and (repo, arch) not in changed and not force:
+            os.link(stale[-1], path)
+        else:
+            print(f"exporting {repo}/{arch}")
+            export.write_export(db, path, repo, arch)
+        for p in stale[:-1]:
+            p.unlink(missing_ok=True)
+
+
+def link_exports(branch, repoarchs, generation, final):
+    # carries the exports over to the generation a copy is swapped in
+    # with; those of the old one are dropped by the next update
+    exportd = config.get("settings", "export-dir", fallback=None)
+    if not exportd:
+        return
+    for repo, arch in repoarchs:
+        path = export.get_export_path(exportd, branch, repo, arch, generation)
+        if not path.exists():
+            continue
+        target = export.get_export_path(exportd, branch, repo, arch, final)
+        target.unlink(missing_ok=True)
+        os.link(path, target)
+
+
+def export_branch(branch):
+    # rewrites the exports of every repo/arch from the current database
+    dbp = config.get("database", "path")
+    db = connect(os.path.join(dbp, f"cports-{branch}.db"))
+    repos = config.get("repository", "repos").split(",")
+    archs = config.get("repository", "arches").split(",")
+    repoarchs = [(repo, arch) for repo in repos for arch in archs]
+    update_exports(db, branch, repoarchs, set(repoarchs), force=True)
+    db.close()
+
+
+def write_update_metrics(branch):
+    # the phase timings of the last run, in the text format of prometheus
+    # for the textfile collector of node_exporter or similar
+    total = time.perf_counter() - phases.started
+    times = dict(phases.times)
+    times["other"] = max(total - sum(times.values()), 0)
+    print(
+        "phases: "
+        + ", ".join(f"{k} {v:.2f}s" for k, v in sorted(times.items()))
+    )
+
+    metricsd = config.get("settings", "metrics-dir", fallback=None)
+    if not metricsd:
+        return
+    lines = [
+        "# HELP apkbrowser_update_phase_seconds Time spent in each phase of the last update.",
+        "# TYPE apkbrowser_update_phase_seconds gauge",
+    ]
+    for phase, seconds in sorted(times.items()):
+        lines.append(
+            f'apkbrowser_update_phase_seconds{{branch="{branch}",phase="{phase}"}} {seconds:.6f}'
+        )
+    lines += [
+        "# HELP apkbrowser_update_duration_seconds Time taken by the last update.",
+        "# TYPE apkbrowser_update_duration_seconds gauge",
+        f'apkbrowser_update_duration_seconds{{branch="{branch}"}} {total:.6f}',
+        "# HELP apkbrowser_update_last_run_timestamp_seconds When the last update finished.",
+        "# TYPE apkbrowser_update_last_run_timestamp_seconds gauge",
+        f'apkbrowser_update_last_run_timestamp_seconds{{branch="{branch}"}} {time.time():.0f}',
+    ]
+    path = pathlib.Path(metricsd, f"update-{branch}.prom")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    replace_file(path, ("\n".join(lines) + "\n").encode())
+
+
+def remove_database(path):
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        pathlib.Path(path + suffix).unlink(missing_ok=True)
+
+
+def merge_live_state(db, live, livepath, copied):
+    # the flags are written to the live database by the web frontend, also
+    # while the copy is being built, so they are carried over from it. the
+    # copy started out at generation copied: if it changed since, it has
+    # to end up past the live one, or the swapped in file could share
+    # validators and cached pages with different content; if not, it is
+    # the live content with the same flags and keeps the live generation.
+    # expects the caller to hold the write lock of the live database, and
+    # returns the generation before and after
+    lcur = live.cursor()
+    lcur.execute("SELECT name FROM sqlite_master WHERE name IN ('flagged', 'meta')")
+    tables = set(map(lambda x: x[0], lcur.fetchall()))
+
+    cur = db.cursor()
+    cur.execute("ATTACH DATABASE ? AS live", [livepath])
+    cur.execute("BEGIN")
+    # read first, the triggers on flagged bump it for every row copied
+    cur.execute("SELECT key, value FROM main.meta")
+    meta = dict(cur.fetchall())
+    generation = meta["generation"]
+    if "flagged" in tables:
+        cur.execute("DELETE FROM main.flagged")
+        cur.execute("INSERT INTO main.flagged SELECT * FROM live.flagged")
+    livegen = 0
+    if "meta" in tables:
+        cur.execute("SELECT value FROM live.meta WHERE key = 'generation'")
+        row = cur.fetchone()
+        livegen = row[0] if row else 0
+    if generation > copied:
+        final = max(generation, livegen + 1)
+    else:
+        final = max(generation, livegen)
+    cur.execute("UPDATE main.meta SET value = ? WHERE key = 'generation'", [final])
+    if final == generation:
+        cur.execute(
+            "UPDATE main.meta SET value = ? WHERE key = 'updated'", [meta["updated"]]
+        )
+    else:
+        cur.execute(f"UPDATE main.meta SET value = {NOW} WHERE key = 'updated'")
+    cur.execute("COMMIT")
+    cur.execute("DETACH DATABASE live")
+    return generation, final
+
+
+def generate_shadow(branch, archs, jobs=1):
+    # builds the new state in a copy and swaps it in once it is complete,
+    # so the live database is never locked for writing and the readers
+    # pick up the new file on their next request
+    dbp = config.get("database", "path")
+    dbpath = os.path.join(dbp, f"cports-{branch}.db")
+    newpath = dbpath + ".new"
+
+    phases.reset()
+    live = connect(dbpath) if os.path.exists(dbpath) else None
+    with phases("fetch"):
+        indexes = fetch_indexes(live, branch, archs, jobs)
+    if not needs_update(indexes):
+        print("nothing to update")
+        if live:
+            live.close()
+        write_update_metrics(branch)
+        return
+
+    remove_database(newpath)
+    db = connect(newpath)
+    if live:
+        print("copying the current database")
+        with phases("copy"):
+            live.backup(db)
+        live.close()
+
     set_options(db)
+    create_tables(db)
+    copied = get_generation(db)
+
+    cur = db.cursor()
+    cur.execute("BEGIN")
+    update_database(db, branch, indexes)
+    with phases("commit"):
+        cur.execute("COMMIT")
+
+    # leave a self-contained file with fresh statistics, as the readers
+    # cannot do either of these
+    with phases("optimize"):
+        cur.execute("ANALYZE")
+        cur.execute("PRAGMA optimize")
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        cur.execute("PRAGMA journal_mode = DELETE")
+    # the pragma above returns a row, and would keep its statement open
+    cur.close()
+
+    # nothing may be written to the live database from here until the
+    # copy has replaced it
+    live = None
+    if os.path.exists(dbpath):
+        live = connect(dbpath)
+        live.cursor().execute("BEGIN IMMEDIATE")
+        with phases("merge"):
+            generation, final = merge_live_state(db, live, dbpath, copied)
+            # the exports were named before the generation was settled
+            if final != generation:
+                link_exports(branch, [(i[0], i[1]) for i in indexes], generation, final)
+    db.close()
+
+    os.replace(newpath, dbpath)
+    if live:
+        live.rollback()
+        live.close()
+    # the write-ahead log of the replaced file must not be applied to
+    # the new one
+    pathlib.Path(dbpath + "-wal").unlink(missing_ok=True)
+    pathlib.Path(dbpath + "-shm").unlink(missing_ok=True)
+    print(f"replaced {dbpath}")
+    write_update_metrics(branch)
+
+
+def generate(branch, archs, jobs=1):
+    dbp = config.get("database", "path")
+
+    db = connect(os.path.join(dbp, f"cports-{branch}.db"))
+
+    set_options(db)
+
+    phases.reset()
+    with phases("fetch"):
+        indexes = fetch_indexes(db, branch, archs, jobs)
 
     cur = db.cursor()
     retries = 0
@@ -494,29 +1642,65 @@ def generate(branch, archs):
             time.sleep(1)
             retries += 1
 
-    create_tables(db)
-
-    repos = config.get("repository", "repos").split(",")
-    if not archs:
-        archs = config.get("repository", "arches").split(",")
-
-    for repo in repos:
-        for arch in archs:
-            apkindex_url = f"{url}/{branch}/{repo}/{arch}/APKINDEX.tar.gz"
-            idxstatus, idxcontent = get_file(apkindex_url)
-            if idxstatus == 200:
-                print(f"parsing {repo}/{arch} APKINDEX")
-                process_apkindex(db, branch, repo, arch, idxcontent)
-            else:
-                print(f"skipping {arch}, {apkindex_url} returned {idxstatus}")
-
-    prune_maintainers(db)
+    update_database(db, branch, indexes)
 
-    cur.execute("COMMIT")
+    with phases("commit"):
+        cur.execute("COMMIT")
+    # the web frontend only has read-only connections, so keep the
+    # planner statistics fresh from here
+    with phases("optimize"):
+        cur.execute("PRAGMA optimize")
     # not autoclosed
     db.close()
+    write_update_metrics(branch)
 
 
 if __name__ == "__main__":
-    for b in config.get("repository", "branches").split(","):
-        generate(b, sys.argv[1:])
+    parser = argparse.ArgumentParser(description="Update the package databases.")
+    parser.add_argument(
+        "--shadow",
+        action="store_true",
+        help="build into a copy of each database and swap it in when done",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of branches to update and indexes to fetch at once",
+    )
+    parser.add_argument(
+        "--export",
+        action="store_true",
+        help="only rewrite the package exports of every branch",
+    )
+    parser.add_argument("archs", nargs="*", help="architectures to update")
+    args = parser.parse_args()
+
+    if args.export:
+        if not config.get("settings", "export-dir", fallback=None):
+            parser.error("export-dir is not configured")
+        for b in config.get("repository", "branches").split(","):
+            export_branch(b)
+        sys.exit(0)
+
+    update = generate_shadow if args.shadow else generate
+    branches = config.get("repository", "branches").split(",")
+
+    if args.jobs <= 1:
+        for b in branches:
+            update(b, args.archs)
+        sys.exit(0)
+
+    # every branch is its own database with its own writer, so they can
+    # be updated in separate processes
+    failed = False
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(branches))) as pool:
+        futs = [(b, pool.submit(update, b, args.archs, args.jobs)) for b in branches]
+        for b, fut in futs:
+            try:
+                fut.result()
+            except Exception as e:
+                print(f"updating {b} failed: {e!r}")
+                failed = True
+    sys.exit(1 if failed else 0)